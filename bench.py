@@ -0,0 +1,346 @@
+# bench.py
+# Benchmark / load-test بدون شبكة للبوت في main.py
+# يبني Updates اصطناعية ويمررها عبر Application.process_update (نفس الـ handlers
+# ونفس التوجيه الحقيقي)، مع طبقة HTTP وهمية تسجل استدعاءات Bot API وتحاكي
+# زمن الاستجابة وأخطاء RetryAfter. قاعدة البيانات مؤقتة وتُملأ ببيانات اصطناعية.
+#
+# مثال:
+#   python bench.py --users 100000 --products 50 --orders 200000 --updates 5000 --concurrency 64
+#   python bench.py --mix browse=5,buy=1,orders=2,admin=1 --max-p99-ms 50   (يفشل بـ exit 1 عند التراجع)
+#   python bench.py --sections 100 --products 1000 --mix search=1 --max-p99-ms 100   (بحث في 100k منتج)
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_ADMIN_ID = 1
+
+DEFAULT_MIX = "browse=6,buy=1,orders=2,start=2,balance=1,admin=1,search=1"
+
+# كلمات أسماء وأوصاف المنتجات: تتكرر بكثرة فيطابق البحث آلاف المنتجات كما في كتالوج حقيقي
+VOCAB = ("بطاقة", "شحن", "جوجل", "ايتونز", "بلايستيشن", "ستيم", "شدات", "جواهر", "اشتراك", "رصيد",
+         "باقة", "انترنت", "حساب", "بريميوم", "شاحن", "كابل", "لعبة", "gift", "card", "usb", "cable",
+         "netflix", "pubg", "xbox", "game", "pass", "phone", "iphone", "samsung", "charger")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline benchmark for the store bot handlers")
+    p.add_argument("--db", help="مسار DB (افتراضياً ملف مؤقت جديد)")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--sections", type=int, default=10)
+    p.add_argument("--products", type=int, default=20, help="منتجات لكل قسم")
+    p.add_argument("--orders", type=int, default=50_000)
+    p.add_argument("--updates", type=int, default=2_000, help="عدد السيناريوهات المنفذة")
+    p.add_argument("--concurrency", type=int, default=32, help="سيناريوهات متزامنة")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="أوزان السيناريوهات name=weight,...")
+    p.add_argument("--api-latency-ms", type=float, default=30.0, help="زمن Bot API المحاكى")
+    p.add_argument("--retry-after-rate", type=float, default=0.0, help="نسبة الردود 429 (0..1)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="اكتب النتائج بصيغة JSON في هذا الملف")
+    p.add_argument("--max-p99-ms", type=float, help="فشل (exit 1) إن تجاوز p99 هذا الحد")
+    p.add_argument("--min-ups", type=float, help="فشل (exit 1) إن قلّ معدل التحديثات/ث عن هذا الحد")
+    return p.parse_args(argv)
+
+
+# main.py يقرأ الإعدادات من البيئة عند الاستيراد، لذلك تُضبط قبل import main
+ARGS = parse_args()
+if ARGS.db is None:
+    ARGS.db = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+os.environ["DB_PATH"] = ARGS.db
+os.environ["BOT_TOKEN"] = "123456:BENCH"
+os.environ["ADMIN_ID"] = str(BENCH_ADMIN_ID)
+
+import main  # noqa: E402
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+
+# === Bot API وهمي ===
+
+class StubRequest(BaseRequest):
+    # يحل محل HTTPXRequest: يسجل كل method، ينتظر api_latency، ويرد بـ 429 بنسبة retry_after_rate
+
+    def __init__(self, api_latency, retry_after_rate, rng):
+        self.api_latency = api_latency
+        self.retry_after_rate = retry_after_rate
+        self.rng = rng
+        self.calls = Counter()
+        self.retry_afters = 0
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if request_data:
+            request_data.json_payload  # كلفة الترميز كما في الطلب الحقيقي
+        self.calls[endpoint] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if self.retry_after_rate and endpoint != "getMe" and self.rng.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1}}
+            return 429, json.dumps(body).encode()
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if endpoint in ("sendMessage", "editMessageText", "sendPhoto", "editMessageMedia"):
+            self._message_id += 1
+            chat_id = params.get("chat_id", 0)
+            return {"message_id": self._message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        return True
+
+
+# === Updates اصطناعية ===
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+
+    def _next(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+    def message(self, uid, text):
+        msg = {"message_id": self._next(), "date": int(time.time()), "text": text,
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": self._next(), "message": msg}, self.bot)
+
+    def callback(self, uid, data):
+        msg = {"message_id": 1, "date": int(time.time()), "text": "menu",
+               "chat": {"id": uid, "type": "private"}, "from": {"id": 123456, "is_bot": True, "first_name": "bench"}}
+        query = {"id": str(self._next()), "from": self._user(uid), "chat_instance": str(uid),
+                 "data": data, "message": msg}
+        return Update.de_json({"update_id": self._next(), "callback_query": query}, self.bot)
+
+
+# === تعبئة DB ===
+
+def seed(args, rng):
+    c = main.db.connect()
+    try:
+        existing = c.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if existing:
+            print(f"DB already seeded ({existing} users) — reusing {args.db}")
+            return
+        t = time.perf_counter()
+        base = time.time() - 365 * 86400
+        c.execute("BEGIN")
+        c.executemany(
+            "INSERT INTO users (id, username, balance, vip_level, created_at) VALUES (?, ?, ?, ?, ?)",
+            ((1000 + i, f"user{1000 + i}", rng.choice((0, 0, 0, 500, 10_000)),
+              rng.choice(("None", "None", "None", "Bronze", "Silver")),
+              time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(base + i * 30)))
+             for i in range(args.users)))
+        c.execute("INSERT INTO ledger (user_id, delta, kind, balance_after, created_at) "
+                  "SELECT id, balance, 'opening', balance, created_at FROM users WHERE balance != 0")
+        c.executemany("INSERT INTO sections (name, position) VALUES (?, ?)",
+                      ((f"Section {s}", s) for s in range(1, args.sections + 1)))
+        c.executemany(
+            "INSERT INTO products (section_id, name, price, description, buttons_json, image_url, position) "
+            "VALUES (?, ?, ?, ?, '[]', '', ?)",
+            ((s, " ".join(rng.choices(VOCAB, k=3)) + f" {s}-{p}", rng.randint(100, 50_000),
+              " ".join(rng.choices(VOCAB, k=8)), p)
+             for s in range(1, args.sections + 1) for p in range(1, args.products + 1)))
+        c.executemany("INSERT INTO products_fts (rowid, name, description) VALUES (?, ?, ?)",
+                      ((pid, main.normalize_search_text(name), main.normalize_search_text(desc))
+                       for pid, name, desc in c.execute("SELECT id, name, description FROM products").fetchall()))
+        n_products = args.sections * args.products
+        if args.users and n_products:
+            c.executemany(
+                "INSERT INTO orders (user_id, product_id, qty, total, status, created_at) VALUES (?, ?, 1, ?, ?, ?)",
+                ((1000 + rng.randrange(args.users), rng.randint(1, n_products), rng.randint(100, 50_000),
+                  rng.choice(("pending", "accepted", "accepted", "rejected")),
+                  time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(base + i)))
+                 for i in range(args.orders)))
+        main._rebuild_sales_rollups(c)
+        c.execute("COMMIT")
+        print(f"Seeded {args.users} users, {args.sections} sections, {n_products} products, "
+              f"{args.orders} orders in {time.perf_counter() - t:.1f}s")
+    finally:
+        c.close()
+
+
+# === السيناريوهات ===
+# كل سيناريو قائمة Updates تُنفذ بالتتابع لنفس المستخدم (كما يضغط إنسان الأزرار)
+
+def scenarios(args, rng, factory):
+    users = [1000 + i for i in range(args.users)] or [1000]
+    sections = list(range(1, args.sections + 1)) or [1]
+    n_products = max(1, args.sections * args.products)
+
+    def browse():
+        uid = rng.choice(users)
+        return "browse", [factory.callback(uid, main.cbdata("browse_sections")),
+                          factory.callback(uid, main.cbdata("section", rng.choice(sections)))]
+
+    def buy():
+        uid = rng.choice(users)
+        return "buy", [factory.callback(uid, main.cbdata("buy", rng.randint(1, n_products)))]
+
+    def orders():
+        uid = rng.choice(users)
+        return "orders", [factory.callback(uid, main.cbdata("my_orders"))]
+
+    def start():
+        # نصف المستخدمين جدد
+        uid = rng.choice(users) if rng.random() < 0.5 else 10_000_000 + rng.randrange(10_000_000)
+        return "start", [factory.message(uid, "/start")]
+
+    def balance():
+        return "balance", [factory.message(rng.choice(users), "رصيدي")]
+
+    def admin():
+        if rng.random() < 0.5:
+            return "admin", [factory.callback(BENCH_ADMIN_ID, main.cbdata("admin_users")),
+                             factory.callback(BENCH_ADMIN_ID, main.cbdata("admin_users_page", 1))]
+        return "admin", [factory.callback(BENCH_ADMIN_ID, main.cbdata("admin_users_search")),
+                         factory.message(BENCH_ADMIN_ID, f"user{rng.choice(users)}")]
+
+    def search():
+        # كلمة شائعة أو بادئتها، أحياناً كلمتان، ثم الصفحة الثانية
+        words = [rng.choice(VOCAB) for _ in range(rng.choice((1, 1, 2)))]
+        words = [w[:rng.randint(2, len(w))] for w in words]
+        uid = rng.choice(users)
+        return "search", [factory.message(uid, "/search " + " ".join(words)),
+                          factory.callback(uid, main.cbdata("search", 1))]
+
+    builders = {"browse": browse, "buy": buy, "orders": orders, "start": start, "balance": balance, "admin": admin,
+                "search": search}
+    weights = {}
+    for part in args.mix.split(","):
+        name, _, w = part.partition("=")
+        if name.strip() not in builders:
+            sys.exit(f"unknown scenario '{name}' (known: {', '.join(builders)})")
+        weights[name.strip()] = float(w or 1)
+    names = list(weights)
+    return [builders[name] for name in rng.choices(names, [weights[n] for n in names], k=args.updates)]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    seed(args, rng)
+    main.catalog.invalidate()
+
+    stub = StubRequest(args.api_latency_ms / 1000, args.retry_after_rate, rng)
+    app = (ApplicationBuilder().token(os.environ["BOT_TOKEN"]).request(stub)
+           .application_class(main.OrderedApplication).concurrent_updates(main.CONCURRENT_UPDATES)
+           .persistence(main.SQLitePersistence())
+           .get_updates_request(StubRequest(0, 0, rng)).updater(None).build())
+    main.register_handlers(app)
+    errors = Counter()
+
+    async def count_errors(update, context):
+        errors[type(context.error).__name__] += 1
+    app.error_handlers.clear()
+    app.add_error_handler(count_errors)
+
+    await app.initialize()
+    await main.on_startup(app)
+    factory = UpdateFactory(app.bot)
+    plan = scenarios(args, rng, factory)
+    latencies = {}
+    all_latencies = []
+    queue = asyncio.Queue()
+    for build in plan:
+        queue.put_nowait(build)
+
+    async def worker():
+        while True:
+            try:
+                build = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            name, updates = build()
+            for update in updates:
+                t = time.perf_counter()
+                await app.process_update(update)
+                dt = time.perf_counter() - t
+                latencies.setdefault(name, []).append(dt)
+                all_latencies.append(dt)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    await main.on_shutdown(app)
+    await app.shutdown()
+
+    result = {
+        "updates": len(all_latencies),
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(all_latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 2),
+        "scenarios": {name: {"count": len(v),
+                             "p50_ms": round(percentile(v, 0.50) * 1000, 2),
+                             "p99_ms": round(percentile(v, 0.99) * 1000, 2)}
+                      for name, v in sorted(latencies.items())},
+        "api_calls": dict(stub.calls),
+        "retry_after": stub.retry_afters,
+        "errors": dict(errors),
+    }
+    return result
+
+
+def report(args, result):
+    print(f"\n{result['updates']} updates in {result['seconds']}s — "
+          f"{result['updates_per_sec']} updates/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
+    print(f"(API latency {args.api_latency_ms} ms, concurrency {args.concurrency}, db {args.db})\n")
+    print(f"{'scenario':<10} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, s in result["scenarios"].items():
+        print(f"{name:<10} {s['count']:>7} {s['p50_ms']:>9} {s['p99_ms']:>9}")
+    print("\nBot API calls:", ", ".join(f"{k}={v}" for k, v in sorted(result["api_calls"].items())))
+    if result["retry_after"] or result["errors"]:
+        print(f"RetryAfter responses: {result['retry_after']}, handler errors: {result['errors']}")
+
+
+def cli():
+    result = asyncio.run(run(ARGS))
+    report(ARGS, result)
+    if ARGS.json:
+        with open(ARGS.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    failed = False
+    if ARGS.max_p99_ms is not None and result["p99_ms"] > ARGS.max_p99_ms:
+        print(f"FAIL: p99 {result['p99_ms']} ms > {ARGS.max_p99_ms} ms")
+        failed = True
+    if ARGS.min_ups is not None and result["updates_per_sec"] < ARGS.min_ups:
+        print(f"FAIL: {result['updates_per_sec']} updates/s < {ARGS.min_ups}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    cli()
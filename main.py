@@ -2,24 +2,51 @@
 # Telegram Store Bot - نسخة أساسية جاهزة بالعديد من الميزات المطلوبة
 # يعتمد على python-telegram-bot (v20 async) و sqlite3
 
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import multiprocessing
 import os
+import queue
+import re
+import secrets
+import signal
+import socket
 import sqlite3
+import sys
+import threading
 import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+import httpx
+
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputMediaPhoto,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
+    PersistenceInput,
     filters,
 )
 
@@ -29,44 +56,261 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID") or 0)
 
+# طريقة استقبال التحديثات: polling (افتراضي) أو webhook
+BOT_MODE = (os.getenv("BOT_MODE") or "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # العنوان العام، مثال https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8443)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # إن لم يُحدد يُولَّد عشوائياً عند كل تشغيل
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or 40)
+# عدد التحديثات المعالجة بالتوازي (تحديثات المستخدم الواحد تبقى بالترتيب)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES") or 32)
+# 0: عملية واحدة. N>0: عملية استقبال توزّع التحديثات على N عمليات عاملة حسب المستخدم
+BOT_WORKERS = int(os.getenv("BOT_WORKERS") or 0)
+SHARD_HOST = os.getenv("SHARD_HOST", "127.0.0.1")
+SHARD_PORT = int(os.getenv("SHARD_PORT") or 0)  # 0: منفذ حر يُختار عند الإقلاع
+
 if not BOT_TOKEN:
     raise Exception("ضع BOT_TOKEN في المتغيرات البيئية (ENV) قبل التشغيل.")
+if BOT_MODE not in ("polling", "webhook"):
+    raise Exception("BOT_MODE يجب أن يكون polling أو webhook.")
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise Exception("ضع WEBHOOK_URL عند استخدام BOT_MODE=webhook.")
 
 # === إعداد قاعدة البيانات SQLite ===
-DB_PATH = "data.db"
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
+DB_PATH = os.getenv("DB_PATH", "data.db")
+DB_READERS = int(os.getenv("DB_READERS") or 4)
+# وضع التخزين: WAL يسمح للقراءة أثناء الكتابة، وFULL يضمن fsync لكل group commit
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL")
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB") or 16384)
+DB_MMAP_MB = int(os.getenv("DB_MMAP_MB") or 128)
+# نافذة تجميع الكتابات قبل commit واحد، وأقصى عدد عمليات في الدفعة
+DB_COMMIT_WINDOW_MS = float(os.getenv("DB_COMMIT_WINDOW_MS") or 2)
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX") or 256)
+
+# === إعدادات البث ===
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY") or 8)
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE") or 500)
+
+# === الحد من الإغراق لكل مستخدم ===
+FLOOD_READ_RATE = float(os.getenv("FLOOD_READ_RATE") or 3)  # تحديث/ثانية للتصفح والبحث
+FLOOD_READ_BURST = float(os.getenv("FLOOD_READ_BURST") or 15)
+FLOOD_WRITE_RATE = float(os.getenv("FLOOD_WRITE_RATE") or 0.5)  # شراء وعرض الرصيد
+FLOOD_WRITE_BURST = float(os.getenv("FLOOD_WRITE_BURST") or 5)
+# تحديثات مرفوضة خلال FLOOD_BAN_WINDOW ثانية تحظر المستخدم تلقائياً؛ 0 يعطل الحظر
+FLOOD_BAN_STRIKES = int(os.getenv("FLOOD_BAN_STRIKES") or 100)
+FLOOD_BAN_WINDOW = float(os.getenv("FLOOD_BAN_WINDOW") or 300)
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS") or 100_000)
+
+# === طلبات Bot API الصادرة ===
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE") or 64)  # اتصالات HTTP المتزامنة إلى Telegram
+API_POOL_TIMEOUT = float(os.getenv("API_POOL_TIMEOUT") or 5)  # انتظار اتصال حر من الـ pool
+API_KEEPALIVE = float(os.getenv("API_KEEPALIVE") or 60)  # ثوانٍ يبقى فيها الاتصال الخامل مفتوحاً
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE") or 30)  # طلب/ثانية لكل البوت (حد Telegram ~30)
+API_BULK_RATE = float(os.getenv("API_BULK_RATE") or 20)  # سقف البث داخل API_GLOBAL_RATE
+API_PER_CHAT_RATE = float(os.getenv("API_PER_CHAT_RATE") or 1)
+API_PER_CHAT_BURST = float(os.getenv("API_PER_CHAT_BURST") or 3)
+
+ADMIN_USERS_PAGE_SIZE = int(os.getenv("ADMIN_USERS_PAGE_SIZE") or 20)
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE") or 10)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE") or 8)
+INLINE_PAGE_SIZE = int(os.getenv("INLINE_PAGE_SIZE") or 20)  # حد Telegram 50
+INLINE_CACHE_SECONDS = int(os.getenv("INLINE_CACHE_SECONDS") or 30)
+# أقصى عدد مطابقات يُرتَّب لكل بحث (الأحدث، مرة لمطابقات الاسم ومرة للكل): يبقي الكلمات الشائعة
+# جداً (كلمة في نصف الكتالوج) بالميلي ثانية، والصفحات داخل هذه المجموعة
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES") or 1000)
+# أقصر كلمة تُطابَق كبادئة؛ الأقصر تُطابَق ككلمة كاملة فقط (بادئة حرف واحد تطابق كل شيء تقريباً)
+SEARCH_MIN_PREFIX = int(os.getenv("SEARCH_MIN_PREFIX") or 2)
+
+# إشعارات الطلبات للأدمن: رسالة واحدة على الأكثر كل ORDER_DIGEST_INTERVAL ثانية تجمع ما تراكم
+ORDER_DIGEST_INTERVAL = float(os.getenv("ORDER_DIGEST_INTERVAL") or 10)
+ORDER_DIGEST_MAX = int(os.getenv("ORDER_DIGEST_MAX") or 20)
+
+# كاش المستخدمين المعروفين أمام ensure_user، وتجميع تسجيل المستخدمين الجدد
+KNOWN_USERS_MAX = int(os.getenv("KNOWN_USERS_MAX") or 200_000)
+USER_UPSERT_WINDOW_MS = float(os.getenv("USER_UPSERT_WINDOW_MS") or 10)
+USER_UPSERT_BATCH_MAX = int(os.getenv("USER_UPSERT_BATCH_MAX") or 500)
+
+# حفظ user_data/chat_data/bot_data في DB (ثوانٍ بين دفعات الكتابة)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL") or 10)
+
+# فحص تطابق الأرصدة مع سجل الحركات في الخلفية (ثوانٍ بين الجولات، ومستخدمين لكل دفعة)
+LEDGER_RECONCILE_INTERVAL = float(os.getenv("LEDGER_RECONCILE_INTERVAL") or 3600)
+LEDGER_RECONCILE_CHUNK = int(os.getenv("LEDGER_RECONCILE_CHUNK") or 1000)
+
+# الاحتفاظ بالطلبات: المكتملة الأقدم من ORDER_RETENTION_DAYS تُنقل إلى أرشيف مضغوط، والمعلقة
+# الأقدم من PENDING_ORDER_TTL_HOURS تُرفض تلقائياً مع إعادة المبلغ (0 يعطل أياً منهما)
+ORDER_RETENTION_DAYS = int(os.getenv("ORDER_RETENTION_DAYS") or 180)
+PENDING_ORDER_TTL_HOURS = float(os.getenv("PENDING_ORDER_TTL_HOURS") or 72)
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL") or 3600)
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH") or 500)  # طلبات لكل معاملة
+RETENTION_PAUSE_MS = float(os.getenv("RETENTION_PAUSE_MS") or 50)  # استراحة بين الدفعات للحركة الحية
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES") or 256)  # صفحات تُعاد للنظام في كل خطوة incremental_vacuum
+
+# نقطة /metrics المحلية (صيغة Prometheus)؛ 0 = القياسات معطلة بالكامل
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+logger = logging.getLogger("store_bot")
+
+# === أدوات خطوات الترحيل ===
+def _add_column(c, table, column, decl):
+    cols = {r[1] for r in c.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _migrate_checkout(c):
+    # stock: NULL = غير محدود. paid: المبلغ المخصوم فعلاً من الرصيد (0 للطلبات القديمة).
+    # idem_key: مفتاح منع التكرار المشتق من الـ callback query
+    _add_column(c, "products", "stock", "INTEGER")
+    _add_column(c, "orders", "paid", "INTEGER DEFAULT 0")
+    _add_column(c, "orders", "idem_key", "TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idem ON orders(idem_key) WHERE idem_key IS NOT NULL")
+
+# === تطبيع النص للبحث ===
+# يُطبَّق على نص الفهرس وعلى الاستعلام معاً: حذف التشكيل والتطويل، توحيد أشكال الألف والياء
+# والتاء المربوطة والهمزات، الأرقام العربية-الهندية إلى لاتينية، وأحرف لاتينية صغيرة.
+_AR_MARKS = re.compile("[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]")
+_AR_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+})
+
+def normalize_search_text(text):
+    return _AR_MARKS.sub("", text or "").translate(_AR_MAP).lower()
+
+def _index_product(c, product_id):
+    # إعادة فهرسة منتج واحد داخل نفس معاملة التعديل. الفهرس يحوي المنتجات المرئية فقط
+    c.execute("DELETE FROM products_fts WHERE rowid=?", (product_id,))
+    r = c.execute("SELECT name, description FROM products WHERE id=? AND visible=1", (product_id,)).fetchone()
+    if r:
+        c.execute("INSERT INTO products_fts (rowid, name, description) VALUES (?, ?, ?)",
+                  (product_id, normalize_search_text(r[0]), normalize_search_text(r[1])))
+
+def _migrate_products_fts(c):
+    # الفهرس يخزن نسخة مطبّعة من الاسم والوصف (rowid = products.id)، لذا يُملأ من Python
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')
+    """)
+    c.executemany("INSERT INTO products_fts (rowid, name, description) VALUES (?, ?, ?)",
+                  ((pid, normalize_search_text(name), normalize_search_text(desc))
+                   for pid, name, desc in c.execute("SELECT id, name, description FROM products WHERE visible=1").fetchall()))
+
+# === تجميعات المبيعات (rollups) ===
+# ثلاثة جداول صغيرة بمفتاح اليوم: إجمالي اليوم، ولكل قسم، ولكل منتج. كل طلب يُحدّثها داخل
+# معاملته نفسها (إنشاء، قبول، رفض) فلا تحتاج لوحة الإحصائيات المرور على orders أبداً. اليوم
+# هو يوم إنشاء الطلب (UTC)، فالقبول أو الرفض لاحقاً يُحسب في صف يوم إنشائه، وإعادة البناء
+# من orders (rebuild_sales_rollups) تعطي نفس الأرقام بالضبط.
+# orders/gross: كل الطلبات ومجموعها، accepted/revenue: المقبولة، rejected/refunded: المرفوضة والمبلغ المُعاد.
+
+SALES_COLUMNS = ("orders", "gross", "accepted", "revenue", "rejected", "refunded")
+
+def _create_sales_tables(c):
+    cols = ", ".join(f"{col} INTEGER NOT NULL DEFAULT 0" for col in SALES_COLUMNS)
+    c.execute(f"CREATE TABLE IF NOT EXISTS sales_by_day (day TEXT PRIMARY KEY, {cols}) WITHOUT ROWID")
+    c.execute(f"""CREATE TABLE IF NOT EXISTS sales_by_section (
+        day TEXT NOT NULL, section_id INTEGER NOT NULL, {cols}, PRIMARY KEY (day, section_id)) WITHOUT ROWID""")
+    c.execute(f"""CREATE TABLE IF NOT EXISTS sales_by_product (
+        day TEXT NOT NULL, product_id INTEGER NOT NULL, section_id INTEGER NOT NULL, {cols},
+        PRIMARY KEY (day, product_id)) WITHOUT ROWID""")
+
+def _rebuild_sales_rollups(c):
+    # مسح كامل لـ orders مرة واحدة. قسم المنتج المحذوف يُؤخذ من صفوفه السابقة إن وُجدت، وإلا 0.
+    # الأيام التي نُقلت طلباتها إلى الأرشيف (قبل orders_archived_before) نهائية وتبقى كما هي
+    r = c.execute("SELECT value FROM settings WHERE key='orders_archived_before'").fetchone()
+    since = r[0] if r else ""
+    sums = ", ".join(f"SUM({col})" for col in SALES_COLUMNS)
+    c.execute("DROP TABLE IF EXISTS temp.sales_sections")
+    c.execute("CREATE TEMP TABLE sales_sections (day TEXT, product_id INTEGER, section_id INTEGER, "
+              "PRIMARY KEY (day, product_id)) WITHOUT ROWID")
+    c.execute("INSERT INTO temp.sales_sections SELECT day, product_id, section_id FROM sales_by_product WHERE day >= ?",
+              (since,))
+    c.execute("DELETE FROM sales_by_day WHERE day >= ?", (since,))
+    c.execute("DELETE FROM sales_by_section WHERE day >= ?", (since,))
+    c.execute("DELETE FROM sales_by_product WHERE day >= ?", (since,))
+    c.execute(f"""
+        INSERT INTO sales_by_product (day, product_id, section_id, {", ".join(SALES_COLUMNS)})
+        SELECT COALESCE(substr(o.created_at, 1, 10), ''), COALESCE(o.product_id, 0),
+               COALESCE(MAX(p.section_id), MAX(old.section_id), 0),
+               COUNT(*), SUM(COALESCE(o.total, 0)),
+               SUM(o.status = 'accepted'), SUM(CASE WHEN o.status = 'accepted' THEN COALESCE(o.total, 0) ELSE 0 END),
+               SUM(o.status = 'rejected'), SUM(CASE WHEN o.status = 'rejected' THEN COALESCE(o.paid, 0) ELSE 0 END)
+        FROM orders o LEFT JOIN products p ON p.id = o.product_id
+        LEFT JOIN temp.sales_sections old ON old.day = substr(o.created_at, 1, 10) AND old.product_id = o.product_id
+        WHERE COALESCE(o.created_at, '') >= ?
+        GROUP BY 1, 2
+    """, (since,))
+    c.execute(f"""INSERT INTO sales_by_section (day, section_id, {", ".join(SALES_COLUMNS)})
+                  SELECT day, section_id, {sums} FROM sales_by_product WHERE day >= ? GROUP BY day, section_id""", (since,))
+    c.execute(f"""INSERT INTO sales_by_day (day, {", ".join(SALES_COLUMNS)})
+                  SELECT day, {sums} FROM sales_by_product WHERE day >= ? GROUP BY day""", (since,))
+    c.execute("DROP TABLE temp.sales_sections")
+    return c.execute("SELECT COUNT(*) FROM sales_by_day WHERE day >= ?", (since,)).fetchone()[0]
 
-# إنشاء الجداول الأساسية
-cur.execute("""
+def _migrate_sales_rollups(c):
+    # خطوة 12 مجمّدة: إعادة بناء كاملة من orders كما كانت عند إضافتها (قبل أرشفة الطلبات).
+    # أي تغيير في طريقة الاشتقاق يذهب إلى _rebuild_sales_rollups وخطوة ترحيل جديدة
+    _create_sales_tables(c)
+    sums = ", ".join(f"SUM({col})" for col in SALES_COLUMNS)
+    c.execute("DROP TABLE IF EXISTS temp.sales_sections")
+    c.execute("CREATE TEMP TABLE sales_sections (day TEXT, product_id INTEGER, section_id INTEGER, "
+              "PRIMARY KEY (day, product_id)) WITHOUT ROWID")
+    c.execute("INSERT INTO temp.sales_sections SELECT day, product_id, section_id FROM sales_by_product")
+    c.execute("DELETE FROM sales_by_day")
+    c.execute("DELETE FROM sales_by_section")
+    c.execute("DELETE FROM sales_by_product")
+    c.execute(f"""
+        INSERT INTO sales_by_product (day, product_id, section_id, {", ".join(SALES_COLUMNS)})
+        SELECT COALESCE(substr(o.created_at, 1, 10), ''), COALESCE(o.product_id, 0),
+               COALESCE(MAX(p.section_id), MAX(old.section_id), 0),
+               COUNT(*), SUM(COALESCE(o.total, 0)),
+               SUM(o.status = 'accepted'), SUM(CASE WHEN o.status = 'accepted' THEN COALESCE(o.total, 0) ELSE 0 END),
+               SUM(o.status = 'rejected'), SUM(CASE WHEN o.status = 'rejected' THEN COALESCE(o.paid, 0) ELSE 0 END)
+        FROM orders o LEFT JOIN products p ON p.id = o.product_id
+        LEFT JOIN temp.sales_sections old ON old.day = substr(o.created_at, 1, 10) AND old.product_id = o.product_id
+        GROUP BY 1, 2
+    """)
+    c.execute(f"""INSERT INTO sales_by_section (day, section_id, {", ".join(SALES_COLUMNS)})
+                  SELECT day, section_id, {sums} FROM sales_by_product GROUP BY day, section_id""")
+    c.execute(f"""INSERT INTO sales_by_day (day, {", ".join(SALES_COLUMNS)})
+                  SELECT day, {sums} FROM sales_by_product GROUP BY day""")
+    c.execute("DROP TABLE temp.sales_sections")
+
+# === ترحيل المخطط (schema migrations) ===
+# كل خطوة تُنفّذ مرة واحدة وبالترتيب داخل معاملة، ورقم آخر خطوة يُحفظ في
+# settings.schema_version. الخطوة إما نص SQL أو دالة fn(conn) للتعديلات التي تحتاج
+# فحص الحالة الحالية (مثل إضافة عمود قد يكون موجوداً في data.db قديم).
+# لا تُعدّل خطوة قديمة أبداً — أضف خطوة جديدة في آخر القائمة.
+MIGRATIONS = [
+    # 1: الجداول الأساسية (مطابقة لما كان يُنشأ قبل نظام الترحيل)
+    (1, """
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY,
     username TEXT,
     balance INTEGER DEFAULT 0,
     vip_level TEXT DEFAULT 'None',
     created_at TEXT
-)
-""")
+);
 
-cur.execute("""
 CREATE TABLE IF NOT EXISTS bans (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER UNIQUE,
     reason TEXT,
     banned_at TEXT
-)
-""")
+);
 
-cur.execute("""
 CREATE TABLE IF NOT EXISTS sections (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT,
     visible INTEGER DEFAULT 1,
     position INTEGER DEFAULT 0
-)
-""")
+);
 
-cur.execute("""
 CREATE TABLE IF NOT EXISTS products (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     section_id INTEGER,
@@ -77,10 +321,8 @@ CREATE TABLE IF NOT EXISTS products (
     visible INTEGER DEFAULT 1,
     image_url TEXT,
     position INTEGER DEFAULT 0
-)
-""")
+);
 
-cur.execute("""
 CREATE TABLE IF NOT EXISTS orders (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER,
@@ -89,159 +331,2202 @@ CREATE TABLE IF NOT EXISTS orders (
     total INTEGER,
     status TEXT DEFAULT 'pending',
     created_at TEXT
-)
-""")
+);
 
-cur.execute("""
 CREATE TABLE IF NOT EXISTS settings (
     key TEXT PRIMARY KEY,
     value TEXT
-)
-""")
+);
+"""),
+    # 2: تقدم البث
+    (2, """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT,
+    status TEXT DEFAULT 'running',  -- running / done
+    cursor INTEGER DEFAULT 0,       -- آخر user id تمت معالجته (keyset)
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    blocked INTEGER DEFAULT 0,
+    created_at TEXT,
+    finished_at TEXT
+);
+"""),
+    # 3: تصفح المستخدمين في لوحة الأدمن بـ keyset على (created_at, id)
+    (3, """
+CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_users_vip_created ON users(created_at, id) WHERE vip_level != 'None';
+CREATE INDEX IF NOT EXISTS idx_users_balance_created ON users(created_at, id) WHERE balance > 0;
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+"""),
+    # 4: فهارس المسارات الساخنة في الـ handlers
+    (4, """
+CREATE INDEX IF NOT EXISTS idx_products_section_position ON products(section_id, position);
+CREATE INDEX IF NOT EXISTS idx_sections_position ON sections(position);
+CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at);
+"""),
+    # 5: سجل الطلبات مقسّم لصفحات بـ keyset على id (ترتيب id = ترتيب created_at)
+    (5, """
+DROP INDEX IF EXISTS idx_orders_user_created;
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders(user_id, status, id);
+"""),
+    # 6: سجل حركات الرصيد (append-only)؛ users.balance يبقى الرصيد المُجسَّد.
+    # الأرصدة الموجودة قبل السجل تُسجّل كحركة opening حتى يتطابق المجموع.
+    (6, """
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    delta INTEGER NOT NULL,
+    kind TEXT NOT NULL,        -- opening / admin_credit / admin_debit / admin_set / purchase / refund
+    ref INTEGER,               -- رقم الطلب لحركات purchase/refund
+    balance_after INTEGER NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id, id);
+INSERT INTO ledger (user_id, delta, kind, balance_after, created_at)
+    SELECT id, balance, 'opening', balance, strftime('%Y-%m-%dT%H:%M:%f', 'now') FROM users WHERE balance != 0;
+CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger
+BEGIN
+    SELECT RAISE(ABORT, 'ledger is append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger
+BEGIN
+    SELECT RAISE(ABORT, 'ledger is append-only');
+END;
+"""),
+    # 7: الدفع من الرصيد عند الشراء + المخزون + منع تكرار الطلب
+    (7, _migrate_checkout),
+    # 8: الطلبات المعلقة لقائمة الأدمن (فهرس جزئي صغير بدل مسح كل الطلبات)
+    (8, """
+CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders(id) WHERE status='pending';
+"""),
+    # 9: file_id الذي أعاده Telegram لصورة المنتج (يُعاد استخدامه بدل رفع image_url كل مرة)
+    (9, lambda c: _add_column(c, "products", "image_file_id", "TEXT")),
+    # 10: حالة PTB (user_data/chat_data/bot_data) كـ JSON لكل مفتاح؛ تُحذف الصفوف الفارغة
+    (10, """
+CREATE TABLE IF NOT EXISTS persistence (
+    kind TEXT NOT NULL,   -- user / chat / bot
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT,
+    PRIMARY KEY (kind, id)
+) WITHOUT ROWID;
+"""),
+    # 11: بحث نصي في المنتجات (FTS5)
+    (11, _migrate_products_fts),
+    # 12: تجميعات المبيعات للوحة الإحصائيات، تُملأ من الطلبات الموجودة
+    (12, _migrate_sales_rollups),
+    # 13: أرشيف الطلبات المكتملة القديمة: كتل JSON مضغوطة (zlib) لكل مستخدم بترتيب id
+    (13, """
+CREATE TABLE IF NOT EXISTS orders_archive (
+    user_id INTEGER NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL,   -- [[id, product_id, name, qty, total, paid, status, created_at], ...]
+    PRIMARY KEY (user_id, first_id)
+) WITHOUT ROWID;
+"""),
+    # 14: حالة الواجهة المؤقتة (EPHEMERAL_KEYS) لم تعد تُحفظ؛ إزالة ما حُفظ منها
+    (14, """
+UPDATE persistence SET data=json_remove(data, '$.search_query', '$.admin_users_view') WHERE kind='user';
+DELETE FROM persistence WHERE data='{}';
+"""),
+    # 15: قائمة المحظورين للأدمن تُقرأ من bans بترتيب الحظر (keyset على banned_at, user_id)
+    (15, """
+UPDATE bans SET banned_at='' WHERE banned_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_bans_banned ON bans(banned_at, user_id);
+"""),
+    # 16: إعادة اشتقاق التجميعات بالقاعدة الحالية: أيام ما قبل orders_archived_before نهائية
+    (16, _rebuild_sales_rollups),
+]
+
+def run_migrations(c):
+    c.isolation_level = None
+    c.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+    r = c.execute("SELECT value FROM settings WHERE key='schema_version'").fetchone()
+    version = int(r[0]) if r else 0
+    for v, step in MIGRATIONS:
+        if v <= version:
+            continue
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if callable(step):
+                step(c)
+            else:
+                for stmt in _split_sql(step):
+                    c.execute(stmt)
+            c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('schema_version', ?)", (str(v),))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        print(f"DB: schema migrated to v{v}")
+        version = v
+    return version
+
+def _split_sql(script):
+    stmts, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            stmts.append(buf.strip())
+            buf = ""
+    if buf.strip():
+        stmts.append(buf.strip())
+    return stmts
+
+# استعلامات الـ handlers التي يجب ألا تمسح جدولاً كاملاً؛ تُفحص بـ EXPLAIN QUERY PLAN
+# عند الإقلاع وبالأمر: python main.py --check-plans
+SEARCH_SQL = """
+    SELECT p.id, p.name, p.price, p.description, p.image_url
+    FROM (SELECT rowid, MIN(score) AS score FROM (
+              SELECT * FROM (SELECT rowid, bm25(products_fts, 10.0, 1.0) AS score FROM products_fts
+                             WHERE products_fts MATCH ? ORDER BY rowid DESC LIMIT ?)
+              UNION ALL
+              SELECT * FROM (SELECT rowid, bm25(products_fts, 10.0, 1.0) AS score FROM products_fts
+                             WHERE products_fts MATCH ? ORDER BY rowid DESC LIMIT ?))
+          GROUP BY rowid ORDER BY score, rowid DESC LIMIT ? OFFSET ?) f
+    JOIN products p ON p.id = f.rowid
+    ORDER BY f.score, f.rowid DESC
+"""
+BANNED_USERS_SQL = """
+    SELECT u.id, u.username, u.balance, u.vip_level, u.created_at, b.banned_at
+    FROM bans b JOIN users u ON u.id = b.user_id
+    ORDER BY b.banned_at DESC, b.user_id DESC LIMIT ?
+"""
+BANNED_USERS_AFTER_SQL = """
+    SELECT u.id, u.username, u.balance, u.vip_level, u.created_at, b.banned_at
+    FROM bans b JOIN users u ON u.id = b.user_id
+    WHERE (b.banned_at, b.user_id) < (?, ?)
+    ORDER BY b.banned_at DESC, b.user_id DESC LIMIT ?
+"""
+SALES_TOTALS_SQL = f"SELECT {', '.join(f'COALESCE(SUM({col}), 0)' for col in SALES_COLUMNS)} FROM sales_by_day WHERE day >= ?"
+SALES_BY_SECTION_SQL = """
+    SELECT s.section_id, sec.name, s.accepted, s.revenue
+    FROM (SELECT section_id, SUM(accepted) AS accepted, SUM(revenue) AS revenue
+          FROM sales_by_section WHERE day >= ? GROUP BY section_id) s
+    LEFT JOIN sections sec ON sec.id = s.section_id
+    ORDER BY s.revenue DESC, s.accepted DESC LIMIT ?
+"""
+SALES_BY_PRODUCT_SQL = """
+    SELECT s.product_id, p.name, s.accepted, s.revenue
+    FROM (SELECT product_id, SUM(accepted) AS accepted, SUM(revenue) AS revenue
+          FROM sales_by_product WHERE day >= ? GROUP BY product_id) s
+    LEFT JOIN products p ON p.id = s.product_id
+    ORDER BY s.revenue DESC, s.accepted DESC LIMIT ?
+"""
+
+HOT_QUERIES = [
+    SEARCH_SQL,
+    BANNED_USERS_SQL,
+    BANNED_USERS_AFTER_SQL,
+    "SELECT balance FROM users WHERE id=?",
+    "SELECT vip_level FROM users WHERE id=?",
+    "SELECT id, name FROM sections WHERE visible=1 ORDER BY position",
+    "SELECT id, name, visible FROM sections ORDER BY position",
+    "SELECT name, visible FROM sections WHERE id=?",
+    "SELECT id, name, price, description, image_url FROM products WHERE section_id=? AND visible=1 ORDER BY position",
+    "SELECT id, name, price, description, visible FROM products WHERE section_id=? ORDER BY position",
+    "SELECT COALESCE(MAX(position),0)+1 FROM products WHERE section_id=?",
+    "SELECT id, section_id, name, price, description, buttons_json, image_url FROM products WHERE id=?",
+    "SELECT user_id, product_id, total FROM orders WHERE id=?",
+    "SELECT o.id, o.total, o.status, p.name FROM orders o LEFT JOIN products p ON p.id = o.product_id WHERE o.user_id=? AND o.id < ? ORDER BY o.id DESC LIMIT ?",
+    "SELECT o.id, o.total, o.status, p.name FROM orders o LEFT JOIN products p ON p.id = o.product_id WHERE o.user_id=? AND o.status=? AND o.id > ? ORDER BY o.id LIMIT ?",
+    "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+    "SELECT id, delta, kind, ref, balance_after, created_at FROM ledger WHERE user_id=? ORDER BY id DESC LIMIT ?",
+    "SELECT o.id, o.total, p.name FROM orders o LEFT JOIN products p ON p.id = o.product_id WHERE o.idem_key=?",
+    "SELECT o.id, o.user_id, p.name, o.total FROM orders o LEFT JOIN products p ON p.id = o.product_id WHERE o.status='pending' ORDER BY o.id LIMIT ?",
+    "SELECT id, username, balance, vip_level, created_at FROM users ORDER BY created_at DESC, id DESC LIMIT ?",
+    "SELECT id, username, balance, vip_level, created_at FROM users WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?",
+    "SELECT id, username, balance, vip_level, created_at FROM users WHERE vip_level != 'None' ORDER BY created_at DESC, id DESC LIMIT ?",
+    "SELECT id, username, balance, vip_level, created_at FROM users WHERE balance > 0 ORDER BY created_at DESC, id DESC LIMIT ?",
+    "SELECT id, username, balance, vip_level, created_at FROM users WHERE username >= ? AND username < ? ORDER BY username LIMIT ?",
+    "SELECT section_id FROM sales_by_product WHERE day=? AND product_id=?",
+    "SELECT 1 FROM orders_archive WHERE user_id=? LIMIT 1",
+    "SELECT data FROM orders_archive WHERE user_id=? AND first_id < ? ORDER BY first_id DESC",
+    "SELECT first_id, count, data FROM orders_archive WHERE user_id=? ORDER BY first_id DESC LIMIT 1",
+    SALES_TOTALS_SQL,
+    SALES_BY_SECTION_SQL,
+    SALES_BY_PRODUCT_SQL,
+]
+
+def check_query_plans(c, queries=HOT_QUERIES):
+    # تعيد [(sql, detail)] لكل خطوة "SCAN <table>" بدون فهرس. مسح نتيجة subquery محدودة
+    # (MATERIALIZE/CO-ROUTINE) ليس مسحاً لجدول فلا يُحسب
+    problems = []
+    for sql in queries:
+        params = (None,) * sql.count("?")
+        subqueries = set()
+        for row in c.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if detail.startswith(("MATERIALIZE ", "CO-ROUTINE ")):
+                subqueries.add(detail.split()[1])
+            elif detail.startswith("SCAN ") and " INDEX " not in f"{detail} " and detail.split()[1] not in subqueries:
+                problems.append((sql, detail))
+    return problems
+
+
+# === القياسات (metrics) ===
+# عدادات وhistograms في الذاكرة تُعرض على /metrics. عند التعطيل: timed() تعيد الدالة
+# نفسها بدون غلاف، وinc/observe تخرج من أول سطر، فلا كلفة تُذكر على المسار الساخن.
+
+class Metrics:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._lock = threading.Lock()  # الكاتب في DB يحدّث من خيط آخر
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name, value, buckets=None, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                bounds = buckets or self.BUCKETS
+                h = self._histograms[key] = [bounds, [0] * len(bounds), 0.0, 0]
+            bounds, counts = h[0], h[1]
+            for i, le in enumerate(bounds):
+                if value <= le:
+                    counts[i] += 1
+                    break
+            h[2] += value
+            h[3] += 1
+
+    def gauge(self, name, fn):
+        # fn() تُستدعى عند كل قراءة لـ /metrics
+        self._gauges[name] = fn
+
+    def timed(self, name, label):
+        # ديكوريتر لدوال async: يسجل زمن التنفيذ في histogram باسم الدالة
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+            labels = {label: fn.__name__}
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                t = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - t, **labels)
+            return wrapper
+        return decorator
+
+    def render(self):
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in items) + "}"
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (h[0], list(h[1]), h[2], h[3])) for k, h in self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), (bounds, counts, total, count) in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for le, c in zip(bounds, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=METRICS_PORT > 0)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # كل استدعاء لـ Bot API يمر من هنا: زمن كل method وأخطاء Telegram حسب النوع،
+    # بما فيها الأخطاء التي تبتلعها الـ handlers لاحقاً.
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        t = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            metrics.inc("bot_telegram_api_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_telegram_api_seconds", time.perf_counter() - t, method=method)
+
+
+async def _serve_metrics(reader, writer):
+    # خادم HTTP صغير جداً: GET /metrics فقط
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+class Database:
+    # طبقة وصول غير متزامنة فوق sqlite3:
+    # - كل الكتابات تمر عبر خيط كاتب واحد (writer thread) باتصال خاص به،
+    #   فلا يوجد تنافس على القفل ولا يوقف fsync الخاص بـ commit حلقة الأحداث.
+    # - الكاتب يجمّع الكتابات المتزامنة من عدة handlers في group commit واحد:
+    #   كل عملية داخل SAVEPOINT خاص بها (فشلها لا يلغي الباقي) ثم COMMIT واحد للدفعة.
+    #   الـ future لا يُحل إلا بعد COMMIT، أي أن الرصيد/الطلب محفوظ قبل تأكيده للمستخدم.
+    # - القراءات تُنفّذ في مجموعة خيوط، لكل خيط اتصاله الخاص (بدون cursor مشترك).
+    # الـ handlers تنتظر (await) النتيجة فقط، وحلقة PTB تبقى حرة لخدمة باقي المستخدمين.
+
+    def __init__(self, path, readers=4, commit_window=0.002, batch_max=256):
+        self.path = path
+        self.readers = readers
+        self.commit_window = commit_window
+        self.batch_max = batch_max
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reader_pool = None
+        self._reader_conns = []
+        self._jobs = queue.Queue()
+        self._writer = None
+
+    def connect(self):
+        c = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        c.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        c.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        c.execute(f"PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024}")
+        c.execute("PRAGMA temp_store=MEMORY")
+        return c
+
+    # --- القراءة ---
+
+    def _reader_conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = self._local.conn = self.connect()
+            with self._lock:
+                self._reader_conns.append(c)
+        return c
+
+    def _run_read(self, fn, args):
+        return fn(self._reader_conn(), *args)
+
+    async def read(self, fn, *args):
+        # fn(conn, *args) تُنفّذ في خيط قراءة وتعيد النتيجة
+        with self._lock:
+            if self._reader_pool is None:
+                self._reader_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db-read")
+            pool = self._reader_pool
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, self._run_read, fn, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda c: c.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda c: c.execute(sql, params).fetchall())
+
+    # --- الكتابة ---
+
+    def _writer_loop(self):
+        conn = self.connect()
+        conn.isolation_level = None  # المعاملات تُدار يدوياً (BEGIN/SAVEPOINT/COMMIT)
+        stop = False
+        while not stop:
+            job = self._jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.monotonic() + self.commit_window
+            while len(batch) < self.batch_max:
+                try:
+                    job = self._jobs.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+            self._commit_batch(conn, batch)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, _loop, _fut in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # فشل COMMIT نفسه (قرص ممتلئ مثلاً): لا شيء من الدفعة محفوظ
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(None, e)] * len(batch)
+            metrics.inc("bot_db_commit_failures_total")
+        metrics.inc("bot_db_commits_total")
+        metrics.observe("bot_db_commit_seconds", time.perf_counter() - started)
+        metrics.observe("bot_db_commit_batch_size", len(batch), buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+        for (_fn, _args, loop, fut), (result, exc) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(_resolve_future, fut, result, exc)
+            except RuntimeError:
+                pass  # حلقة الأحداث أُغلقت قبل وصول النتيجة
+
+    async def write(self, fn, *args):
+        # fn(conn, *args) تُنفّذ كوحدة ذرية داخل group commit؛ تُعاد النتيجة بعد COMMIT
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                self._writer.start()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._jobs.put((fn, args, loop, fut))
+        return await fut
+
+    async def execute(self, sql, params=()):
+        # تعيد lastrowid
+        return await self.write(lambda c: c.execute(sql, params).lastrowid)
+
+    def close(self):
+        # تُستدعى عند الإيقاف: تنهي الكاتب بعد تفريغ الطابور وتغلق اتصالات القراءة
+        with self._lock:
+            writer, self._writer = self._writer, None
+            pool, self._reader_pool = self._reader_pool, None
+            conns, self._reader_conns = self._reader_conns, []
+        if writer is not None:
+            self._jobs.put(None)
+            writer.join()
+        if pool is not None:
+            pool.shutdown(wait=True)
+        for c in conns:
+            c.close()
+        self._local = threading.local()
+
+
+def _resolve_future(fut, result, exc):
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
 
-conn.commit()
+db = Database(DB_PATH, DB_READERS, DB_COMMIT_WINDOW_MS / 1000, DB_BATCH_MAX)
+metrics.gauge("bot_db_write_queue_depth", db._jobs.qsize)
+
+
+class SettingsCache:
+    # نسخة في الذاكرة من جدول settings: تُحمّل مرة عند الإقلاع وتُحدَّث عبر save_setting
+    # (write-through)، فلا يحتاج عرض أي شاشة إلى SELECT على settings.
+
+    def __init__(self):
+        self._values = {}
+
+    def load(self, conn):
+        self._values = dict(conn.execute("SELECT key, value FROM settings").fetchall())
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = str(value)
+
+    @property
+    def currency(self) -> str:
+        return self._values.get("currency") or "SYP"
+
+    @property
+    def welcome_msg(self) -> str:
+        return self._values.get("welcome_msg") or "أهلاً بك!"
+
+
+settings = SettingsCache()
+
+# معرّفات المحظورين في الذاكرة: تُحمّل عند الإقلاع وتُحدّث من ban_user/unban_user
+banned_ids = set()
+
+
+def init_db():
+    # ترحيل المخطط والإعدادات الافتراضية (متزامن، مرة واحدة عند الإقلاع)
+    c = db.connect()
+    try:
+        # incremental vacuum يحتاج auto_vacuum=INCREMENTAL؛ يسري مباشرة على DB جديد فقط، وعلى DB
+        # قائم يحتاج VACUUM كاملاً (بطيء ويحتاج ضعف المساحة) فيبقى أمراً صريحاً
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if c.execute("PRAGMA page_count").fetchone()[0]:
+                print("DB: auto_vacuum is off; freed pages are reused but not returned to disk. "
+                      "Stop the bot and run: python main.py --enable-incremental-vacuum")
+            else:
+                c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        run_migrations(c)
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                  ("welcome_msg", "أهلا بك في متجرنا 🎉\nتصفح الأقسام بالأسفل."))
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                  ("currency", "SYP"))  # الليرة السورية كمفتاح
+        settings.load(c)
+        banned_ids.update(r[0] for r in c.execute("SELECT user_id FROM bans"))
+        for sql, detail in check_query_plans(c):
+            print(f"DB: full scan ({detail}) in: {sql}")
+    finally:
+        c.close()
+
+init_db()
 
 
 # === أدوات مساعدة للتعامل مع DB ===
+# كل الدوال هنا async وتمر عبر db، لا يوجد cursor عام مشترك بين الـ coroutines.
 
 def now_ts():
     return datetime.utcnow().isoformat()
 
-def ensure_user(user_id, username=None):
-    cur.execute("SELECT id FROM users WHERE id=?", (user_id,))
-    if cur.fetchone() is None:
-        cur.execute("INSERT INTO users (id, username, created_at) VALUES (?, ?, ?)",
-                    (user_id, username or "", now_ts()))
-        conn.commit()
+# --- users ---
+
+def _upsert_users(c, rows):
+    # مستخدم جديد: INSERT؛ موجود: لا شيء، إلا إذا تغيّر اسم المستخدم (ولا نكتب اسماً فارغاً فوق اسم)
+    c.executemany("""
+        INSERT INTO users (id, username, created_at) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET username=excluded.username
+        WHERE excluded.username != '' AND users.username IS NOT excluded.username
+    """, rows)
+
+class KnownUsers:
+    # LRU بالمستخدمين الموجودين في DB واسم المستخدم الأخير لكل منهم:
+    # المستخدم العائد بنفس الاسم لا يكلف أي استعلام. غير ذلك يُجمّع خلال نافذة قصيرة
+    # في upsert واحد (executemany)، و/start متزامنة لنفس المستخدم تندمج في صف واحد.
+
+    def __init__(self, max_size, window, batch_max):
+        self.max_size = max_size
+        self.window = window
+        self.batch_max = batch_max
+        self._known = OrderedDict()
+        self._pending = {}
+        self._batch = None
 
-def get_balance(user_id):
-    cur.execute("SELECT balance FROM users WHERE id=?", (user_id,))
-    r = cur.fetchone()
+    def _remember(self, user_id, username):
+        self._known[user_id] = username
+        self._known.move_to_end(user_id)
+        if len(self._known) > self.max_size:
+            self._known.popitem(last=False)
+
+    async def ensure(self, user_id, username=None):
+        username = username or ""
+        known = self._known.get(user_id)
+        if known is not None and (not username or known == username):
+            self._known.move_to_end(user_id)
+            return
+        self._pending[user_id] = username or self._pending.get(user_id, "")
+        loop = asyncio.get_running_loop()
+        if self._batch is None:
+            self._batch = loop.create_future()
+            loop.call_later(self.window, lambda: loop.create_task(self._flush()))
+        batch = self._batch
+        if len(self._pending) >= self.batch_max:
+            loop.create_task(self._flush())
+        await asyncio.shield(batch)
+
+    async def _flush(self):
+        batch, pending = self._batch, self._pending
+        if batch is None:
+            return  # دفعة أُرسلت مسبقاً (امتلأت قبل انتهاء النافذة)
+        self._batch, self._pending = None, {}
+        ts = now_ts()
+        try:
+            await db.write(_upsert_users, [(uid, name, ts) for uid, name in pending.items()])
+        except Exception as e:
+            batch.set_exception(e)
+            return
+        for uid, name in pending.items():
+            known = self._known.get(uid)
+            self._remember(uid, name or known or "")
+        batch.set_result(None)
+
+
+known_users = KnownUsers(KNOWN_USERS_MAX, USER_UPSERT_WINDOW_MS / 1000, USER_UPSERT_BATCH_MAX)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def ensure_user(user_id, username=None):
+    await known_users.ensure(user_id, username)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_balance(user_id):
+    r = await db.fetchone("SELECT balance FROM users WHERE id=?", (user_id,))
     return r[0] if r else 0
 
-def set_balance(user_id, amount):
-    ensure_user(user_id)
-    cur.execute("UPDATE users SET balance = ? WHERE id=?", (amount, user_id))
-    conn.commit()
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_vip_level(user_id):
+    r = await db.fetchone("SELECT vip_level FROM users WHERE id=?", (user_id,))
+    return r[0] if r else "None"
 
-def add_balance(user_id, delta):
-    ensure_user(user_id)
-    cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (delta, user_id))
-    conn.commit()
+def _ensure_user_row(c, user_id):
+    c.execute("INSERT OR IGNORE INTO users (id, username, created_at) VALUES (?, ?, ?)",
+              (user_id, "", now_ts()))
 
-def list_users():
-    cur.execute("SELECT id, username, balance, vip_level FROM users ORDER BY created_at DESC")
-    return cur.fetchall()
+# === الرصيد وسجل الحركات (ledger) ===
+# كل تغيير في الرصيد = صف في ledger + تحديث users.balance داخل نفس المعاملة (نفس
+# الـ SAVEPOINT في خيط الكاتب)، فلا يمكن أن يتغير أحدهما دون الآخر. الكتابات المتزامنة
+# تُنفّذ بالتتابع في خيط الكاتب وتُجمع في group commit واحد، فلا سباق read-modify-write.
 
-def ban_user(user_id, reason=""):
-    cur.execute("INSERT OR REPLACE INTO bans (user_id, reason, banned_at) VALUES (?, ?, ?)",
-                (user_id, reason, now_ts()))
-    conn.commit()
+def _post_ledger(c, user_id, delta, kind, ref=None):
+    _ensure_user_row(c, user_id)
+    c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (delta, user_id))
+    balance = c.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()[0]
+    c.execute("INSERT INTO ledger (user_id, delta, kind, ref, balance_after, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+              (user_id, delta, kind, ref, balance, now_ts()))
+    return balance
 
-def unban_user(user_id):
-    cur.execute("DELETE FROM bans WHERE user_id=?", (user_id,))
-    conn.commit()
+def _set_balance(c, user_id, amount):
+    _ensure_user_row(c, user_id)
+    current = c.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()[0]
+    return _post_ledger(c, user_id, amount - current, "admin_set")
 
-def is_banned(user_id):
-    cur.execute("SELECT 1 FROM bans WHERE user_id=?", (user_id,))
-    return cur.fetchone() is not None
+@metrics.timed("bot_db_query_seconds", "query")
+async def set_balance(user_id, amount):
+    return await db.write(_set_balance, user_id, amount)
 
-def save_setting(key, value):
-    cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-    conn.commit()
+@metrics.timed("bot_db_query_seconds", "query")
+async def add_balance(user_id, delta, kind=None, ref=None):
+    # تعيد الرصيد الجديد
+    kind = kind or ("admin_credit" if delta >= 0 else "admin_debit")
+    return await db.write(_post_ledger, user_id, delta, kind, ref)
 
-def load_setting(key, default=None):
-    cur.execute("SELECT value FROM settings WHERE key=?", (key,))
-    r = cur.fetchone()
-    return r[0] if r else default
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_ledger(user_id, limit=10):
+    return await db.fetchall("SELECT id, delta, kind, ref, balance_after, created_at FROM ledger WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                             (user_id, limit))
+
+def _reconcile_chunk(c, after_id, limit):
+    rows = c.execute("""
+        SELECT u.id, u.balance, (SELECT COALESCE(SUM(delta), 0) FROM ledger l WHERE l.user_id = u.id)
+        FROM users u WHERE u.id > ? ORDER BY u.id LIMIT ?
+    """, (after_id, limit)).fetchall()
+    mismatches = [(uid, bal, total) for uid, bal, total in rows if bal != total]
+    return (rows[-1][0] if rows else None), mismatches
+
+async def reconcile_ledger(chunk=1000):
+    # مقارنة users.balance بمجموع ledger على دفعات صغيرة (قراءة فقط، لا تعطل الـ handlers)
+    after, mismatches = 0, []
+    while after is not None:
+        after, found = await db.read(_reconcile_chunk, after, chunk)
+        mismatches += found
+        await asyncio.sleep(0)
+    return mismatches
+
+async def ledger_reconcile_loop(interval, chunk):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mismatches = await reconcile_ledger(chunk)
+        except Exception:
+            logger.exception("Ledger reconciliation failed")
+            continue
+        metrics.inc("bot_ledger_reconcile_runs_total")
+        metrics.inc("bot_ledger_mismatches_total", len(mismatches))
+        for uid, bal, total in mismatches[:20]:
+            logger.warning("Ledger mismatch for user %s: balance=%s ledger=%s", uid, bal, total)
 
-# إعدادات افتراضية
-if load_setting("welcome_msg") is None:
-    save_setting("welcome_msg", "أهلا بك في متجرنا 🎉\nتصفح الأقسام بالأسفل.")
+# فلاتر تصفح المستخدمين؛ شروط vip/balance مطابقة حرفياً لشروط الفهارس الجزئية في SCHEMA
+USER_FILTERS = {
+    "all": "",
+    "banned": None,  # يُقرأ من bans بترتيب الحظر (BANNED_USERS_SQL)
+    "vip": "vip_level != 'None'",
+    "balance": "balance > 0",
+}
 
-if load_setting("currency") is None:
-    save_setting("currency", "SYP")  # الليرة السورية كمفتاح
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_users_page(flt="all", after=None, limit=20):
+    # صفحة واحدة بترتيب الأحدث أولاً؛ after = (created_at, id) لآخر صف في الصفحة السابقة.
+    # التكلفة ثابتة مهما كبر الجدول (لا OFFSET ولا COUNT). المحظورون بترتيب الأحدث حظراً، وafter
+    # لهم = (banned_at, id). العمود الأخير في كل صف هو مفتاح الصفحة التالية
+    if flt == "banned":
+        if after:
+            return await db.fetchall(BANNED_USERS_AFTER_SQL, (*after, limit))
+        return await db.fetchall(BANNED_USERS_SQL, (limit,))
+    where, params = [], []
+    if USER_FILTERS[flt]:
+        where.append(USER_FILTERS[flt])
+    if after:
+        where.append("(created_at, id) < (?, ?)")
+        params += list(after)
+    sql = "SELECT id, username, balance, vip_level, created_at FROM users"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    return await db.fetchall(sql, (*params, limit))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def search_users(query, limit=20):
+    # بحث بالـ ID الكامل أو ببادئة اسم المستخدم (نطاق على idx_users_username)
+    query = query.strip().lstrip("@")
+    if not query:
+        return []
+    if query.isdigit():
+        return await db.fetchall("SELECT id, username, balance, vip_level, created_at FROM users WHERE id=?", (int(query),))
+    return await db.fetchall(
+        "SELECT id, username, balance, vip_level, created_at FROM users WHERE username >= ? AND username < ? ORDER BY username LIMIT ?",
+        (query, query + "\uffff", limit))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_user_ids_after(after_id, limit):
+    # صفحة من المعرّفات بترتيب المفتاح الأساسي (keyset) — بدون تحميل كل الجدول
+    rows = await db.fetchall("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+    return [r[0] for r in rows]
+
+# --- bans ---
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def ban_user(user_id, reason=""):
+    await db.execute("INSERT OR REPLACE INTO bans (user_id, reason, banned_at) VALUES (?, ?, ?)",
+                     (user_id, reason, now_ts()))
+    banned_ids.add(user_id)
+    cluster.publish("ban", user_id, True)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def unban_user(user_id):
+    await db.execute("DELETE FROM bans WHERE user_id=?", (user_id,))
+    banned_ids.discard(user_id)
+    cluster.publish("ban", user_id, False)
+
+def is_banned(user_id):
+    # من الذاكرة فقط — بدون استعلام
+    return user_id in banned_ids
+
+# --- settings ---
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def save_setting(key, value):
+    await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+    settings.set(key, value)
+    cluster.publish("setting", key, str(value))
+    if key == "currency":
+        catalog.invalidate()  # صفحات الأقسام تعرض العملة
+
+def load_setting(key, default=None):
+    # من الكاش فقط — بدون استعلام
+    return settings.get(key, default)
 
 # === أدوات المتجر (sections/products) ===
 
-def create_section(name):
-    cur.execute("SELECT COALESCE(MAX(position),0)+1 FROM sections")
-    pos = cur.fetchone()[0] or 1
-    cur.execute("INSERT INTO sections (name, position) VALUES (?, ?)", (name, pos))
-    conn.commit()
-    return cur.lastrowid
+def _create_section(c, name):
+    pos = c.execute("SELECT COALESCE(MAX(position),0)+1 FROM sections").fetchone()[0] or 1
+    return c.execute("INSERT INTO sections (name, position) VALUES (?, ?)", (name, pos)).lastrowid
 
-def list_sections(only_visible=True):
+@metrics.timed("bot_db_query_seconds", "query")
+async def create_section(name):
+    sid = await db.write(_create_section, name)
+    catalog.invalidate(sections=True)
+    return sid
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_sections(only_visible=True):
     if only_visible:
-        cur.execute("SELECT id, name FROM sections WHERE visible=1 ORDER BY position")
-    else:
-        cur.execute("SELECT id, name, visible FROM sections ORDER BY position")
-    return cur.fetchall()
+        return await db.fetchall("SELECT id, name FROM sections WHERE visible=1 ORDER BY position")
+    return await db.fetchall("SELECT id, name, visible FROM sections ORDER BY position")
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_section(section_id):
+    return await db.fetchone("SELECT name, visible FROM sections WHERE id=?", (section_id,))
 
-def create_product(section_id, name, price, description="", buttons_json="[]", image_url="", position=None):
+def _delete_section(c, section_id):
+    c.execute("DELETE FROM products_fts WHERE rowid IN (SELECT id FROM products WHERE section_id=?)", (section_id,))
+    c.execute("DELETE FROM sections WHERE id=?", (section_id,))
+    c.execute("DELETE FROM products WHERE section_id=?", (section_id,))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def delete_section(section_id):
+    await db.write(_delete_section, section_id)
+    catalog.invalidate(section_id, sections=True)
+
+def _create_product(c, section_id, name, price, description, buttons_json, image_url, position):
     if position is None:
-        cur.execute("SELECT COALESCE(MAX(position),0)+1 FROM products WHERE section_id=?", (section_id,))
-        position = cur.fetchone()[0] or 1
-    cur.execute("""
+        position = c.execute("SELECT COALESCE(MAX(position),0)+1 FROM products WHERE section_id=?",
+                             (section_id,)).fetchone()[0] or 1
+    pid = c.execute("""
         INSERT INTO products (section_id, name, price, description, buttons_json, image_url, position)
         VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (section_id, name, price, description, buttons_json, image_url, position))
-    conn.commit()
-    return cur.lastrowid
+    """, (section_id, name, price, description, buttons_json, image_url, position)).lastrowid
+    _index_product(c, pid)
+    return pid
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def create_product(section_id, name, price, description="", buttons_json="[]", image_url="", position=None):
+    pid = await db.write(_create_product, section_id, name, price, description, buttons_json, image_url, position)
+    catalog.invalidate(section_id)
+    return pid
 
-def list_products(section_id=None, only_visible=True):
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_products(section_id=None, only_visible=True):
     if section_id is None:
         if only_visible:
-            cur.execute("SELECT id, section_id, name, price, description, image_url FROM products WHERE visible=1 ORDER BY position")
-        else:
-            cur.execute("SELECT id, section_id, name, price, description, visible FROM products ORDER BY position")
+            return await db.fetchall("SELECT id, section_id, name, price, description, image_url FROM products WHERE visible=1 ORDER BY position")
+        return await db.fetchall("SELECT id, section_id, name, price, description, visible FROM products ORDER BY position")
+    if only_visible:
+        return await db.fetchall("SELECT id, name, price, description, image_url FROM products WHERE section_id=? AND visible=1 ORDER BY position", (section_id,))
+    return await db.fetchall("SELECT id, name, price, description, visible FROM products WHERE section_id=? ORDER BY position", (section_id,))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_product(product_id):
+    return await db.fetchone("SELECT id, section_id, name, price, description, buttons_json, image_url, stock FROM products WHERE id=?", (product_id,))
+
+def _set_product_image(c, product_id, image_url):
+    c.execute("UPDATE products SET image_url=?, image_file_id=NULL WHERE id=?", (image_url, product_id))
+    r = c.execute("SELECT section_id FROM products WHERE id=?", (product_id,)).fetchone()
+    return r[0] if r else None
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def set_product_image(product_id, image_url):
+    # تغيير الصورة يُسقط file_id القديم من DB والذاكرة ويلغي لقطة القسم
+    sid = await db.write(_set_product_image, product_id, image_url)
+    media_cache.forget(product_id)
+    if sid is not None:
+        catalog.invalidate(sid)
+    return sid
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_product_image(product_id):
+    return await db.fetchone("SELECT image_url, image_file_id FROM products WHERE id=?", (product_id,))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def save_image_file_id(product_id, image_url, file_id):
+    # مشروط بنفس image_url: رفع قديم انتهى بعد تغيير الصورة لا يكتب file_id خاطئاً
+    await db.execute("UPDATE products SET image_file_id=? WHERE id=? AND image_url=?", (file_id, product_id, image_url))
+
+def _update_product(c, product_id, column, value):
+    c.execute(f"UPDATE products SET {column}=? WHERE id=?", (value, product_id))
+    if column in ("name", "description"):
+        _index_product(c, product_id)
+    r = c.execute("SELECT section_id FROM products WHERE id=?", (product_id,)).fetchone()
+    return r[0] if r else None
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def rename_product(product_id, name):
+    sid = await db.write(_update_product, product_id, "name", name)
+    if sid is not None:
+        catalog.invalidate(sid)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def set_product_price(product_id, price):
+    sid = await db.write(_update_product, product_id, "price", price)
+    if sid is not None:
+        catalog.invalidate(sid)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def set_product_stock(product_id, stock):
+    # stock=None يعني غير محدود
+    await db.execute("UPDATE products SET stock=? WHERE id=?", (stock, product_id))
+
+def _delete_product(c, product_id):
+    r = c.execute("SELECT section_id FROM products WHERE id=?", (product_id,)).fetchone()
+    c.execute("DELETE FROM products WHERE id=?", (product_id,))
+    c.execute("DELETE FROM products_fts WHERE rowid=?", (product_id,))
+    return r[0] if r else None
+
+# === البحث في المنتجات ===
+
+def fts_query(text):
+    # كل كلمة بادئة ("كلمة"*)، والكلمات مجتمعة (AND). علامات التنصيص تُحذف مع غير الحروف
+    tokens = re.findall(r"\w+", normalize_search_text(text))[:8]
+    return " ".join(f'"{t}"*' if len(t) >= SEARCH_MIN_PREFIX else f'"{t}"' for t in tokens)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def search_products(text, limit, offset=0):
+    # الأفضل أولاً (الاسم أثقل من الوصف) بين المرشحين: أحدث SEARCH_CANDIDATES مطابقة في الاسم
+    # وأحدثها في أي عمود. FTS5 يقرأ المطابقات بترتيب rowid بلا فرز، فالكلفة محدودة مهما شاعت الكلمة
+    match = fts_query(text)
+    if not match:
+        return []
+    return await db.fetchall(SEARCH_SQL, (f"{{name}} : ({match})", SEARCH_CANDIDATES,
+                                          match, SEARCH_CANDIDATES, limit, offset))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def delete_product(product_id):
+    sid = await db.write(_delete_product, product_id)
+    if sid is not None:
+        catalog.invalidate(sid)
+
+# === الطلبات (orders) ===
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def create_order(user_id, product_id, qty, total, status="pending"):
+    return await db.execute("INSERT INTO orders (user_id, product_id, qty, total, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                            (user_id, product_id, qty, total, status, now_ts()))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_order(order_id):
+    return await db.fetchone("SELECT user_id, product_id, total FROM orders WHERE id=?", (order_id,))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def set_order_status(order_id, status):
+    await db.execute("UPDATE orders SET status=? WHERE id=?", (status, order_id))
+
+# === الشراء (checkout) ===
+# كل الشراء معاملة واحدة في خيط الكاتب: السعر + VIP + الرصيد في استعلام واحد، ثم حجز
+# المخزون وخصم الرصيد (ledger) وإنشاء الطلب. خيط الكاتب ينفذ المعاملات بالتتابع، والخصم
+# المشروط على المخزون يمنع البيع الزائد حتى تحت ضغط متزامن.
+# الضغط المزدوج على "شراء" يعطي نفس idem_key فيعود بنفس الطلب بدلاً من طلب جديد.
+
+VIP_DISCOUNT_PERCENT = {"Bronze": 1, "Silver": 2}
+
+def vip_price(price, vip):
+    return price - price * VIP_DISCOUNT_PERCENT.get(vip, 0) // 100
+
+def _rollup(c, day, product_id, **deltas):
+    # حدث طلب واحد في جداول المبيعات الثلاثة، داخل معاملة الطلب نفسها. القسم يُؤخذ من صف
+    # المنتج في ذلك اليوم إن وُجد (فيبقى القبول/الرفض بعد حذف المنتج في نفس القسم)
+    r = (c.execute("SELECT section_id FROM sales_by_product WHERE day=? AND product_id=?", (day, product_id)).fetchone()
+         or c.execute("SELECT section_id FROM products WHERE id=?", (product_id,)).fetchone())
+    section_id = (r[0] if r else None) or 0
+    cols = ", ".join(deltas)
+    marks = ", ".join("?" * len(deltas))
+    sets = ", ".join(f"{col}={col}+excluded.{col}" for col in deltas)
+    values = tuple(deltas.values())
+    c.execute(f"INSERT INTO sales_by_day (day, {cols}) VALUES (?, {marks}) "
+              f"ON CONFLICT(day) DO UPDATE SET {sets}", (day, *values))
+    c.execute(f"INSERT INTO sales_by_section (day, section_id, {cols}) VALUES (?, ?, {marks}) "
+              f"ON CONFLICT(day, section_id) DO UPDATE SET {sets}", (day, section_id, *values))
+    c.execute(f"INSERT INTO sales_by_product (day, product_id, section_id, {cols}) VALUES (?, ?, ?, {marks}) "
+              f"ON CONFLICT(day, product_id) DO UPDATE SET {sets}", (day, product_id, section_id, *values))
+
+def _checkout(c, user_id, product_id, idem_key):
+    # تعيد (status, order_id, name, total) حيث status: ok / duplicate / not_found / sold_out / insufficient
+    if idem_key:
+        r = c.execute("SELECT o.id, o.total, p.name FROM orders o LEFT JOIN products p ON p.id = o.product_id "
+                      "WHERE o.idem_key=?", (idem_key,)).fetchone()
+        if r:
+            return "duplicate", r[0], r[2], r[1]
+    _ensure_user_row(c, user_id)
+    r = c.execute("""
+        SELECT p.name, p.price, p.stock, u.vip_level, u.balance
+        FROM products p JOIN users u ON u.id = ?
+        WHERE p.id = ? AND p.visible = 1
+    """, (user_id, product_id)).fetchone()
+    if not r:
+        return "not_found", None, None, None
+    name, price, stock, vip, balance = r
+    total = vip_price(price, vip)
+    if stock is not None and stock <= 0:
+        return "sold_out", None, name, total
+    if balance < total:
+        return "insufficient", None, name, total
+    if stock is not None:
+        if c.execute("UPDATE products SET stock = stock - 1 WHERE id=? AND stock > 0", (product_id,)).rowcount == 0:
+            return "sold_out", None, name, total
+    created_at = now_ts()
+    order_id = c.execute("""
+        INSERT INTO orders (user_id, product_id, qty, total, paid, status, idem_key, created_at)
+        VALUES (?, ?, 1, ?, ?, 'pending', ?, ?)
+    """, (user_id, product_id, total, total, idem_key, created_at)).lastrowid
+    _post_ledger(c, user_id, -total, "purchase", order_id)
+    _rollup(c, created_at[:10], product_id, orders=1, gross=total)
+    return "ok", order_id, name, total
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def checkout(user_id, product_id, idem_key=None):
+    result = await db.write(_checkout, user_id, product_id, idem_key)
+    metrics.inc("bot_checkout_total", status=result[0])
+    return result
+
+def _settle_order(c, order_id, status):
+    # pending -> accepted/rejected مرة واحدة فقط؛ الرفض يعيد المبلغ المدفوع والمخزون
+    r = c.execute("SELECT user_id, product_id, total, paid, created_at FROM orders WHERE id=? AND status='pending'",
+                  (order_id,)).fetchone()
+    if not r:
+        return None
+    user_id, product_id, total, paid, created_at = r
+    c.execute("UPDATE orders SET status=? WHERE id=?", (status, order_id))
+    day = (created_at or "")[:10]
+    if status == "rejected":
+        if paid:
+            _post_ledger(c, user_id, paid, "refund", order_id)
+        c.execute("UPDATE products SET stock = stock + 1 WHERE id=? AND stock IS NOT NULL", (product_id,))
+        _rollup(c, day, product_id or 0, rejected=1, refunded=paid or 0)
     else:
-        if only_visible:
-            cur.execute("SELECT id, name, price, description, image_url FROM products WHERE section_id=? AND visible=1 ORDER BY position", (section_id,))
+        _rollup(c, day, product_id or 0, accepted=1, revenue=total or 0)
+    return user_id
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def settle_order(order_id, status):
+    # تعيد user_id صاحب الطلب، أو None إن لم يكن الطلب معلقاً (غير موجود أو عولج مسبقاً)
+    return await db.write(_settle_order, order_id, status)
+
+def _settle_orders(c, order_ids, status):
+    settled = []
+    for oid in order_ids:
+        user_id = _settle_order(c, oid, status)
+        if user_id is not None:
+            settled.append((oid, user_id))
+    return settled
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def settle_orders(order_ids, status):
+    # معالجة جماعية في معاملة واحدة؛ تعيد [(order_id, user_id)] لما كان معلقاً فعلاً
+    return await db.write(_settle_orders, list(order_ids), status)
+
+# --- الإحصائيات ---
+
+def _sales_summary(c, since, limit):
+    return (c.execute(SALES_TOTALS_SQL, (since,)).fetchone(),
+            c.execute(SALES_BY_SECTION_SQL, (since, limit)).fetchall(),
+            c.execute(SALES_BY_PRODUCT_SQL, (since, limit)).fetchall())
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def sales_summary(days, limit=5):
+    # (totals, [(section_id, name, accepted, revenue)], [(product_id, name, accepted, revenue)]) لآخر days يوم.
+    # من جداول التجميع فقط: صف لكل يوم/قسم/منتج، مهما كبر جدول orders
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    return await db.read(_sales_summary, since, limit)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def rebuild_sales_rollups():
+    return await db.write(_rebuild_sales_rollups)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_pending_orders(order_ids=None, limit=ORDER_DIGEST_MAX):
+    # [(order_id, user_id, product_name, total)] الأقدم أولاً
+    sql = ("SELECT o.id, o.user_id, p.name, o.total FROM orders o "
+           "LEFT JOIN products p ON p.id = o.product_id WHERE o.status='pending'")
+    if order_ids is None:
+        return await db.fetchall(sql + " ORDER BY o.id LIMIT ?", (limit,))
+    order_ids = list(order_ids)
+    if not order_ids:
+        return []
+    marks = ",".join("?" * len(order_ids))
+    return await db.fetchall(sql + f" AND o.id IN ({marks}) ORDER BY o.id", order_ids)
+
+def checkout_key(q):
+    # نفس الرسالة بنفس النسخة (edit_date) ونفس الزر = نفس محاولة الشراء
+    msg = q.message
+    if msg is None:
+        # رسائل البحث المضمّن: لا message ولا edit_date، لكن inline_message_id ثابت للرسالة،
+        # وزر الشراء يحمل nonce يتجدد بعد كل شراء ناجح (inline_buy_keyboard)
+        if q.inline_message_id:
+            return f"{q.from_user.id}:i:{q.inline_message_id}:{q.data}"
+        return f"q:{q.id}"
+    version = int((msg.edit_date or msg.date).timestamp())
+    return f"{q.from_user.id}:{msg.chat.id}:{msg.message_id}:{version}:{q.data}"
+
+def _list_user_orders_page(c, user_id, status, before, after, limit):
+    cond, params = "o.user_id=?", [user_id]
+    if status:
+        cond += " AND o.status=?"
+        params.append(status)
+    sql = ("SELECT o.id, o.total, o.status, p.name FROM orders o "
+           "LEFT JOIN products p ON p.id = o.product_id WHERE " + cond)
+    if after is not None:
+        # الصفحة الأحدث: نقرأ تصاعدياً ثم نعكس
+        rows = c.execute(sql + " AND o.id > ? ORDER BY o.id LIMIT ?", (*params, after, limit)).fetchall()[::-1]
+    else:
+        rows = c.execute(sql + " AND o.id < ? ORDER BY o.id DESC LIMIT ?",
+                         (*params, before if before is not None else 2 ** 63 - 1, limit)).fetchall()
+    if not rows:
+        return rows, False, False
+    probe = "SELECT 1 FROM orders o WHERE " + cond
+    has_older = c.execute(probe + " AND o.id < ? LIMIT 1", (*params, rows[-1][0])).fetchone() is not None
+    has_newer = c.execute(probe + " AND o.id > ? LIMIT 1", (*params, rows[0][0])).fetchone() is not None
+    return rows, has_older, has_newer
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_user_orders_page(user_id, status=None, before=None, after=None, limit=10):
+    # صفحة من سجل الطلبات باستعلام JOIN واحد (بدون N+1)؛ before/after = id حدود الصفحة.
+    # تعيد (rows, has_older, has_newer) والتكلفة ثابتة مهما كثرت طلبات المستخدم.
+    return await db.read(_list_user_orders_page, user_id, status, before, after, limit)
+
+# === الاحتفاظ بالطلبات: انتهاء المعلقة، الأرشفة، incremental vacuum ===
+# تعمل كـ job دوري في JobQueue على دفعات صغيرة، كل دفعة معاملة قصيرة في طابور الكاتب نفسه
+# مع استراحة بين الدفعات، فلا تحجز DB عن الـ handlers. الطلبات المؤرشفة تُحذف من orders
+# وتُحفظ في orders_archive ككتل مضغوطة لكل مستخدم (حتى ARCHIVE_CHUNK طلب في الكتلة)،
+# وتُعرض في سجل المستخدم عند الطلب. تجميعات المبيعات لا تتأثر بالأرشفة.
+
+ARCHIVE_CHUNK = 200
+
+def _expire_pending_orders(c, cutoff, limit):
+    # رفض المعلقة الأقدم من cutoff (إعادة المبلغ والمخزون وتحديث التجميعات عبر _settle_order)
+    expired = []
+    for oid, created_at in c.execute("SELECT id, created_at FROM orders WHERE status='pending' ORDER BY id LIMIT ?",
+                                     (limit,)).fetchall():
+        if (created_at or "") >= cutoff:
+            break
+        user_id = _settle_order(c, oid, "rejected")
+        if user_id is not None:
+            expired.append((oid, user_id))
+    return expired
+
+def _pack_orders(orders):
+    return zlib.compress(json.dumps(orders, ensure_ascii=False, separators=(",", ":")).encode())
+
+def _unpack_orders(blob):
+    return json.loads(zlib.decompress(blob))
+
+def _archive_orders(c, after_id, cutoff, limit):
+    # دفعة من الأقدم (ترتيب id = ترتيب created_at). تعيد (آخر id فُحص، عدد المؤرشف، هل انتهى)
+    rows = c.execute("""
+        SELECT o.id, o.user_id, o.product_id, p.name, o.qty, o.total, o.paid, o.status, o.created_at
+        FROM orders o LEFT JOIN products p ON p.id = o.product_id
+        WHERE o.id > ? ORDER BY o.id LIMIT ?
+    """, (after_id, limit)).fetchall()
+    done = len(rows) < limit
+    by_user = {}
+    for oid, user_id, product_id, name, qty, total, paid, status, created_at in rows:
+        if (created_at or "") >= cutoff:
+            done = True
+            break
+        after_id = oid
+        if status != "pending":
+            by_user.setdefault(user_id, []).append([oid, product_id, name, qty, total, paid, status, created_at])
+    archived = 0
+    for user_id, orders in by_user.items():
+        last = c.execute("SELECT first_id, count, data FROM orders_archive WHERE user_id=? ORDER BY first_id DESC LIMIT 1",
+                         (user_id,)).fetchone()
+        if last and last[1] + len(orders) <= ARCHIVE_CHUNK:
+            merged = _unpack_orders(last[2]) + orders
+            c.execute("UPDATE orders_archive SET last_id=?, count=?, data=? WHERE user_id=? AND first_id=?",
+                      (orders[-1][0], len(merged), _pack_orders(merged), user_id, last[0]))
+        else:
+            c.execute("INSERT INTO orders_archive (user_id, first_id, last_id, count, data) VALUES (?, ?, ?, ?, ?)",
+                      (user_id, orders[0][0], orders[-1][0], len(orders), _pack_orders(orders)))
+        c.executemany("DELETE FROM orders WHERE id=?", ((o[0],) for o in orders))
+        archived += len(orders)
+    if done:
+        c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('orders_archived_before', ?)", (cutoff,))
+    return after_id, archived, done
+
+def _freelist_count(c):
+    return c.execute("PRAGMA freelist_count").fetchone()[0]
+
+def _incremental_vacuum(c, pages):
+    # pages > 0 دائماً: incremental_vacuum(0) يفرغ القائمة كلها دفعة واحدة
+    c.execute(f"PRAGMA incremental_vacuum({max(1, int(pages))})").fetchall()
+    return _freelist_count(c)
+
+async def run_retention(bot):
+    pause = RETENTION_PAUSE_MS / 1000
+    now = datetime.utcnow()
+    expired = archived = 0
+    if PENDING_ORDER_TTL_HOURS > 0:
+        cutoff = (now - timedelta(hours=PENDING_ORDER_TTL_HOURS)).isoformat()
+        while True:
+            batch = await db.write(_expire_pending_orders, cutoff, RETENTION_BATCH)
+            if batch:
+                expired += len(batch)
+                order_notifier.tell_users(bot, [
+                    (uid, f"⌛ انتهت مهلة مراجعة طلبك #{oid} فأُلغي وأُعيد المبلغ إلى رصيدك.") for oid, uid in batch])
+            if len(batch) < RETENTION_BATCH:
+                break
+            await asyncio.sleep(pause)
+    if ORDER_RETENTION_DAYS > 0:
+        cutoff = (now.date() - timedelta(days=ORDER_RETENTION_DAYS)).isoformat()
+        after_id, done = 0, False
+        while not done:
+            after_id, n, done = await db.write(_archive_orders, after_id, cutoff, RETENTION_BATCH)
+            archived += n
+            await asyncio.sleep(pause)
+    free = await db.read(_freelist_count)
+    # نتوقف إن لم تتقلّص قائمة الصفحات الحرة (مثلاً auto_vacuum غير مفعّل)
+    prev = None
+    while free > 0 and free != prev:
+        prev = free
+        free = await db.write(_incremental_vacuum, VACUUM_PAGES)
+        await asyncio.sleep(pause)
+    metrics.inc("bot_orders_expired_total", expired)
+    metrics.inc("bot_orders_archived_total", archived)
+    if expired or archived:
+        logger.info("Retention: expired %d pending orders, archived %d orders", expired, archived)
+
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await run_retention(context.bot)
+    except Exception:
+        logger.exception("Order retention failed")
+
+async def retention_loop(bot, interval):
+    # بديل JobQueue إن لم تُثبّت python-telegram-bot[job-queue]
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_retention(bot)
+        except Exception:
+            logger.exception("Order retention failed")
+
+def _list_archived_orders(c, user_id, before, limit):
+    # صفحة من أرشيف المستخدم، الأحدث أولاً: (rows, has_older)، rows = [(id, total, status, name)]
+    rows = []
+    for (blob,) in c.execute("SELECT data FROM orders_archive WHERE user_id=? AND first_id < ? ORDER BY first_id DESC",
+                             (user_id, before if before is not None else 2 ** 63 - 1)):
+        for oid, _pid, name, _qty, total, _paid, status, _created in reversed(_unpack_orders(blob)):
+            if before is None or oid < before:
+                rows.append((oid, total, status, name))
+        if len(rows) > limit:
+            break
+    return rows[:limit], len(rows) > limit
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_archived_orders(user_id, before=None, limit=10):
+    return await db.read(_list_archived_orders, user_id, before, limit)
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def has_archived_orders(user_id):
+    return await db.fetchone("SELECT 1 FROM orders_archive WHERE user_id=? LIMIT 1", (user_id,)) is not None
+
+# === البث (broadcasts) ===
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def create_broadcast(text):
+    return await db.execute("INSERT INTO broadcasts (text, created_at) VALUES (?, ?)", (text, now_ts()))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def get_broadcast(broadcast_id):
+    return await db.fetchone("SELECT text, status, cursor, sent, failed, blocked FROM broadcasts WHERE id=?", (broadcast_id,))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def list_running_broadcasts():
+    return [r[0] for r in await db.fetchall("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")]
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def save_broadcast_progress(broadcast_id, cursor, sent, failed, blocked):
+    await db.execute("UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=? WHERE id=?",
+                     (cursor, sent, failed, blocked, broadcast_id))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def finish_broadcast(broadcast_id):
+    await db.execute("UPDATE broadcasts SET status='done', finished_at=? WHERE id=?", (now_ts(), broadcast_id))
+
+@metrics.timed("bot_db_query_seconds", "query")
+async def fail_broadcast(broadcast_id):
+    # failed: توقف بخطأ غير متوقع؛ لا يُستأنف تلقائياً عند الإقلاع (cursor والعدادات محفوظة كما هي)
+    await db.execute("UPDATE broadcasts SET status='failed', finished_at=? WHERE id=?", (now_ts(), broadcast_id))
+
+# === محددات المعدل (token bucket) ===
+
+class TokenBucket:
+    # rate توكن/ثانية بسعة capacity. يعمل داخل حلقة asyncio واحدة فلا يحتاج أقفالاً.
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n=1):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    async def acquire(self, n=1):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+    def take(self, n=1):
+        # خصم بلا انتظار (قد يصبح الرصيد سالباً حتى -capacity): من ينتظر acquire يتأخر بقدره
+        self._refill(time.monotonic())
+        self.tokens = max(-self.capacity, min(self.capacity, self.tokens - n))
+
+    def pause(self, seconds):
+        # عند RetryAfter من Telegram: لا توكنات لأي أحد حتى انتهاء المهلة
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class KeyedRateLimiter:
+    # bucket لكل مفتاح (chat/user) مع ذاكرة محدودة: يُطرد الأقدم استخداماً (LRU)
+
+    def __init__(self, rate, capacity=None, max_keys=100_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def bucket(self, key):
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return b
+
+    def try_acquire(self, key, n=1):
+        return self.bucket(key).try_acquire(n)
+
+    async def acquire(self, key, n=1):
+        await self.bucket(key).acquire(n)
+
+# === جدولة طلبات Bot API الصادرة ===
+# كل طلب يصدر بأولوية السياق الذي أُرسل منه (contextvar): ردود الـ handlers تفاعلية افتراضياً،
+# والمهام الخلفية تضبط أولويتها عند بدايتها، فلا تحتاج الاستدعاءات نفسها أي وسيط إضافي.
+
+PRIORITY_INTERACTIVE, PRIORITY_TRANSACTIONAL, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "transactional", "bulk")
+
+api_priority = contextvars.ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+
+class ApiScheduler:
+    # حد عام وحد لكل محادثة، بثلاث أولويات:
+    # - interactive: لا تنتظر أبداً؛ تخصم من الحدود فقط فيتأخر ما بعدها بقدر ما استهلكت.
+    # - transactional: تنتظر توكناً عاماً وتسبق أي bulk منتظر.
+    # - bulk: تحت سقف إضافي bulk_rate، فيبقى جزء من الحد العام متاحاً دائماً لما فوقها،
+    #   ولا تأخذ توكناً عاماً إلا إن لم يكن هناك transactional ينتظر.
+    # الانتظار طابور FIFO لكل أولوية تخدمه مهمة واحدة (pump) بمعدل الحد العام.
+
+    def __init__(self, rate, bulk_rate, per_chat_rate, per_chat_burst):
+        self.bucket = TokenBucket(rate)
+        self.bulk = TokenBucket(bulk_rate)
+        self.per_chat = KeyedRateLimiter(per_chat_rate, per_chat_burst)
+        self._waiters = (deque(), deque())  # transactional، bulk
+        self._pump_task = None
+
+    def queued(self):
+        return sum(len(q) for q in self._waiters)
+
+    async def acquire(self, priority, chat_id=None):
+        if priority == PRIORITY_INTERACTIVE:
+            self.bucket.take()
+            if chat_id is not None:
+                self.per_chat.bucket(chat_id).take()
+            return
+        if chat_id is not None:
+            await self.per_chat.acquire(chat_id)
+        if priority == PRIORITY_BULK:
+            await self.bulk.acquire()
+        ahead = self._waiters[0] if priority == PRIORITY_TRANSACTIONAL else self._waiters
+        if not any(ahead) and self.bucket.try_acquire():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[priority - 1].append(fut)
+        if self._pump_task is None:
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump())
+        await fut
+
+    async def _pump(self):
+        while True:
+            for q in self._waiters:
+                while q and q[0].done():
+                    q.popleft()  # ألغى صاحبه الانتظار
+            if not any(self._waiters):
+                self._pump_task = None
+                return
+            await self.bucket.acquire()
+            for q in self._waiters:
+                while q and q[0].done():
+                    q.popleft()
+                if q:
+                    q.popleft().set_result(None)
+                    break
+            else:
+                self.bucket.take(-1)  # لم يبقَ من ينتظر: أعد التوكن
+
+    def backoff(self, priority, chat_id, seconds):
+        # RetryAfter: نوقف المحادثة المعنية إن وُجدت وإلا الحد العام، والبث كله عند 429 من bulk.
+        # interactive لا تنتظر الـ buckets أصلاً فتبقى سريعة؛ Telegram يقرر إن كان سيقبلها.
+        if chat_id is not None:
+            self.per_chat.bucket(chat_id).pause(seconds)
         else:
-            cur.execute("SELECT id, name, price, description, visible FROM products WHERE section_id=? ORDER BY position", (section_id,))
-    return cur.fetchall()
+            self.bucket.pause(seconds)
+        if priority == PRIORITY_BULK:
+            self.bulk.pause(seconds)
+
+    async def stop(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+            self._pump_task = None
+
+
+api_scheduler = ApiScheduler(API_GLOBAL_RATE, API_BULK_RATE, API_PER_CHAT_RATE, API_PER_CHAT_BURST)
+metrics.gauge("bot_api_queued", api_scheduler.queued)
+
+class ScheduledRequest(InstrumentedRequest):
+    # HTTP client بحجم pool وkeep-alive قابلين للضبط: اتصالات TLS تبقى دافئة بين الدفعات بدل
+    # مصافحة جديدة بعد كل فترة هدوء. كل طلب ينتظر دوره في ApiScheduler قبل أن يأخذ اتصالاً،
+    # فلا يحجز البث اتصالات الـ pool وهو ينتظر الحد.
+
+    def __init__(self, scheduler, pool_size, keepalive, pool_timeout):
+        super().__init__(connection_pool_size=pool_size, pool_timeout=pool_timeout)
+        self.scheduler = scheduler
+        # HTTPXRequest (PTB 20.3) لا يعرض keepalive_expiry؛ نعيد بناء الـ client بحدود كاملة
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive)
+        self._client = self._build_client()
+
+    async def post(self, url, request_data=None, *args, **kwargs):
+        priority = api_priority.get()
+        chat_id = request_data.parameters.get("chat_id") if request_data else None
+        t = time.perf_counter()
+        await self.scheduler.acquire(priority, chat_id)
+        metrics.observe("bot_api_queue_seconds", time.perf_counter() - t, priority=PRIORITY_NAMES[priority])
+        try:
+            return await super().post(url, request_data, *args, **kwargs)
+        except RetryAfter as e:
+            self.scheduler.backoff(priority, chat_id, e.retry_after)
+            raise
+
+# === محرك البث في الخلفية ===
+
+class Broadcaster:
+    # يرسل البث كمهمة خلفية: المستلمون يُقرأون صفحة صفحة من DB، الإرسال بتوازٍ محدود
+    # وبأولوية bulk في ApiScheduler، وهو المحدد الوحيد للمعدل (API_BULK_RATE، الحد لكل محادثة
+    # وما يتبقى من الحد العام بعد الردود والإشعارات، وإيقاف RetryAfter). التقدم (cursor والعدادات)
+    # يُحفظ بعد كل صفحة في جدول broadcasts، فيُستأنف البث بعد إعادة التشغيل
+    # (قد تتكرر رسائل صفحة واحدة على الأكثر إن توقف البوت في منتصفها).
+
+    REPORT_EVERY = 5.0  # ثوانٍ بين تحديثات تقرير التقدم للأدمن
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, concurrency, page_size):
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self._tasks = {}
+
+    def start(self, bot, broadcast_id):
+        task = asyncio.get_running_loop().create_task(self.run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(broadcast_id, None))
+        return task
 
-def get_product(product_id):
-    cur.execute("SELECT id, section_id, name, price, description, buttons_json, image_url FROM products WHERE id=?", (product_id,))
-    return cur.fetchone()
+    async def stop(self):
+        # الإيقاف يترك البث بحالة running ليُستأنف من آخر صفحة محفوظة
+        tasks = list(self._tasks.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send(self, bot, sem, chat_id, text):
+        async with sem:
+            for _ in range(self.MAX_ATTEMPTS):
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text)
+                    return "sent"
+                except RetryAfter:
+                    pass  # ScheduledRequest أوقف فئة bulk مدة retry_after؛ المحاولة التالية تنتظرها
+                except Forbidden:
+                    return "blocked"  # المستخدم حظر البوت
+                except NetworkError:
+                    await asyncio.sleep(1)
+                except TelegramError:
+                    return "failed"
+            return "failed"
+
+    async def _report(self, bot, message, text):
+        try:
+            if message is None:
+                return await bot.send_message(chat_id=ADMIN_ID, text=text)
+            await bot.edit_message_text(chat_id=ADMIN_ID, message_id=message.message_id, text=text)
+        except TelegramError:
+            pass
+        return message
+
+    async def run(self, bot, broadcast_id):
+        api_priority.set(PRIORITY_BULK)  # سياق المهمة نفسها فقط
+        try:
+            await self._run(bot, broadcast_id)
+        except Exception as e:
+            # خطأ DB أو شبكة أو RetryAfter بعد نفاد المحاولات: لا تنتهِ المهمة بصمت وتبقى الحالة running
+            logger.exception("broadcast %s failed", broadcast_id)
+            try:
+                await fail_broadcast(broadcast_id)
+            except Exception:
+                logger.exception("broadcast %s: could not persist failed status", broadcast_id)
+            await self._report(bot, None, f"❌ توقف البث #{broadcast_id} بسبب خطأ غير متوقع: {type(e).__name__}\n"
+                                          f"التقدم محفوظ حتى آخر صفحة مكتملة.")
+
+    async def _run(self, bot, broadcast_id):
+        row = await get_broadcast(broadcast_id)
+        if not row or row[1] != "running":
+            return
+        text, _status, cursor, sent, failed, blocked = row
+        sem = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+        done_at_start = sent + failed + blocked
+        last_report = 0.0
+        message = await self._report(bot, None, f"📢 البث #{broadcast_id} قيد الإرسال...")
+
+        def progress(final=False):
+            elapsed = max(time.monotonic() - started, 0.001)
+            rate = (sent + failed + blocked - done_at_start) / elapsed
+            head = f"✅ اكتمل البث #{broadcast_id}" if final else f"📢 البث #{broadcast_id} قيد الإرسال..."
+            return (f"{head}\nتم الإرسال: {sent}\nفشل: {failed}\nحظروا البوت: {blocked}\n"
+                    f"السرعة: {rate:.1f} رسالة/ث")
+
+        while True:
+            ids = await list_user_ids_after(cursor, self.page_size)
+            if not ids:
+                break
+            results = await asyncio.gather(*(self._send(bot, sem, uid, text) for uid in ids))
+            for result in ("sent", "failed", "blocked"):
+                metrics.inc("bot_broadcast_messages_total", results.count(result), result=result)
+            sent += results.count("sent")
+            failed += results.count("failed")
+            blocked += results.count("blocked")
+            cursor = ids[-1]
+            await save_broadcast_progress(broadcast_id, cursor, sent, failed, blocked)
+            if time.monotonic() - last_report >= self.REPORT_EVERY:
+                last_report = time.monotonic()
+                await self._report(bot, message, progress())
+        await finish_broadcast(broadcast_id)
+        await self._report(bot, message, progress(final=True))
+
+
+broadcaster = Broadcaster(BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE)
+metrics.gauge("bot_broadcasts_running", lambda: len(broadcaster._tasks))
+
+# === إشعارات الطلبات للأدمن ===
+
+def order_buttons(order_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("قبول", callback_data=cbdata("admin_order_accept", order_id))],
+        [InlineKeyboardButton("رفض", callback_data=cbdata("admin_order_reject", order_id))]
+    ])
+
+def render_order_digest(orders, selected=()):
+    # orders: [(order_id, user_id, product_name, total)]. حالة التحديد محفوظة في الأزرار نفسها
+    # (☑️/⬜) فلا تحتاج الرسالة أي حالة في الذاكرة وتبقى صالحة بعد إعادة التشغيل.
+    currency = settings.currency
+    text = f"🧾 طلبات معلقة ({len(orders)}):\n"
+    for oid, uid, name, total in orders:
+        text += f"\n#{oid} — {name or '؟'} — {total} {currency} — المستخدم {uid}"
+    text += "\n\nحدّد ما تريد رفضه ثم اضغط «رفض المحدد»، و«قبول الكل» يقبل كل غير المحدد."
+    kb, row = [], []
+    for oid, *_ in orders:
+        mark = "☑️" if oid in selected else "⬜"
+        row.append(InlineKeyboardButton(f"{mark} #{oid}", callback_data=cbdata("admin_orders_toggle", oid)))
+        if len(row) == 4:
+            kb.append(row)
+            row = []
+    if row:
+        kb.append(row)
+    kb.append([InlineKeyboardButton("✅ قبول الكل", callback_data=cbdata("admin_orders_accept")),
+               InlineKeyboardButton("❌ رفض المحدد", callback_data=cbdata("admin_orders_reject"))])
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_back"))])
+    return text, InlineKeyboardMarkup(kb)
+
+def order_digest_state(markup):
+    # (ids المعروضة، ids المحددة) من أزرار رسالة الـ digest
+    ids, selected = [], set()
+    for row in (markup.inline_keyboard if markup else ()):
+        for b in row:
+            decoded = callbacks.decode(b.callback_data)
+            if decoded and decoded[0][0] == "admin_orders_toggle":
+                oid = decoded[1][0]
+                ids.append(oid)
+                if b.text.startswith("☑️"):
+                    selected.add(oid)
+    return ids, selected
+
+class OrderNotifier:
+    # الطلبات الجديدة تدخل طابوراً بدل send_message فوري لكل طلب. عند هدوء الحركة يُرسل
+    # الطلب فوراً كرسالة مستقلة؛ وتحت الضغط تُرسل رسالة واحدة على الأكثر كل interval ثانية
+    # تجمع ما تراكم (digest). RetryAfter/NetworkError تُبقي الطلبات في الطابور لإعادة المحاولة.
+    # الطابور في الذاكرة: ما لم يُرسل قبل الإيقاف يبقى ظاهراً في "الطلبات المعلقة".
+
+    def __init__(self, interval, max_batch):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queue = []
+        self._wake = asyncio.Event()
+        self._task = None
+        self._last_sent = 0.0
+        self._tell_tasks = set()
+
+    def notify(self, bot, order):
+        # مع عدة عمال: كل الطلبات إلى طابور العامل القائد (مالك محادثة الأدمن)، فيبقى digest واحد
+        if not cluster.owns(ADMIN_ID) and cluster.send(ADMIN_ID, "order", list(order)):
+            return
+        self._queue.append(order)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run(bot))
+        self._wake.set()
+
+    async def stop(self):
+        tasks = list(self._tell_tasks)
+        if self._task is not None:
+            tasks.append(self._task)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    async def _send(self, bot, batch):
+        # True = أُرسل أو لا فائدة من إعادة المحاولة، False = أعد المحاولة لاحقاً
+        if len(batch) == 1:
+            oid, uid, name, total = batch[0]
+            text = f"طلب جديد #{oid}\nالمنتج: {name}\nالسعر: {total} {settings.currency}\nالمستخدم: {uid}"
+            markup = order_buttons(oid)
+        else:
+            text, markup = render_order_digest(batch)
+        try:
+            await bot.send_message(chat_id=ADMIN_ID, text=text, reply_markup=markup)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            return False
+        except NetworkError:
+            return False
+        except TelegramError as e:
+            logger.warning("Dropping admin notification for %d orders: %s", len(batch), e)
+            metrics.inc("bot_order_notifications_total", len(batch), result="dropped")
+            return True
+        metrics.inc("bot_order_notifications_total", len(batch), result="digest" if len(batch) > 1 else "single")
+        return True
+
+    async def run(self, bot):
+        api_priority.set(PRIORITY_TRANSACTIONAL)
+        while True:
+            if not self._queue:
+                self._wake.clear()
+                await self._wake.wait()
+            wait = self._last_sent + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            batch = self._queue[:self.max_batch]
+            if await self._send(bot, batch):
+                del self._queue[:len(batch)]
+            self._last_sent = time.monotonic()
+
+    def tell_users(self, bot, messages):
+        # إبلاغ أصحاب الطلبات في الخلفية، بأولوية transactional. رسائل محادثات عمال آخرين
+        # تُرسل إليهم ليبقى كل إرسال لمحادثة من عاملها المالك
+        local, remote = [], {}
+        for chat_id, text in messages:
+            if cluster.owns(chat_id):
+                local.append((chat_id, text))
+            else:
+                remote.setdefault(cluster.shard_of(chat_id), []).append((chat_id, text))
+        for batch in remote.values():
+            if not cluster.send(batch[0][0], "tell", [list(m) for m in batch]):
+                local.extend(batch)  # لا رابط بالاستقبال: نرسلها من هنا
+        if not local:
+            return
+        messages = local
+
+        async def run():
+            api_priority.set(PRIORITY_TRANSACTIONAL)
+            for chat_id, text in messages:
+                for _ in range(2):
+                    try:
+                        await bot.send_message(chat_id=chat_id, text=text)
+                    except RetryAfter as e:
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    except TelegramError:
+                        pass
+                    break
+        task = asyncio.get_running_loop().create_task(run())
+        self._tell_tasks.add(task)
+        task.add_done_callback(self._tell_tasks.discard)
+
+
+order_notifier = OrderNotifier(ORDER_DIGEST_INTERVAL, ORDER_DIGEST_MAX)
+metrics.gauge("bot_order_notifications_queued", lambda: len(order_notifier._queue))
+
+# === توجيه الأزرار (callback_data) ===
+# كل زر مسار في جدول CALLBACK_ROUTES: (الاسم، رمز مختصر، handler، أنواع الوسائط، للأدمن فقط).
+# الصيغة: "<نسخة><رمز>:<وسيط>:..." مثل "1s:2n" (القسم 95)؛ الأرقام base36 لتبقى ضمن حد
+# Telegram (64 بايت). ما لا يبدأ برقم النسخة هو الصيغة القديمة "<الاسم>:<وسيط>..." بأرقام
+# عشرية، ويبقى مفهوماً لأزرار الرسائل المرسلة سابقاً. التوجيه بحث واحد في dict،
+# والتصادمات تُرفض عند التسجيل وتجاوز 64 بايت يُفحص عند الإقلاع (check).
+
+CALLBACK_VERSION = "1"
+CALLBACK_DATA_MAX = 64
+_B36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _b36(n):
+    if n < 0:
+        return "-" + _b36(-n)
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36[r] + out
+        if not n:
+            return out
+
+class CbInt:
+    sample = -(2 ** 63)  # أطول قيمة ممكنة، لفحص الطول
+
+    def encode(self, value):
+        return _b36(int(value))
+
+    def decode(self, raw, legacy):
+        return int(raw, 10 if legacy else 36)
+
+class CbStr:
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.sample = "x" * max_len
+
+    def encode(self, value):
+        value = str(value)
+        if ":" in value or len(value) > self.max_len:
+            raise ValueError(f"bad callback string {value!r}")
+        return value
+
+    def decode(self, raw, legacy):
+        return raw
+
+class CbCursor:
+    # مؤشر صفحة keyset: ("o", id) للأقدم من id، ("n", id) للأحدث
+    sample = ("o", 2 ** 63 - 1)
+
+    def encode(self, value):
+        direction, key = value
+        return direction + _b36(key)
+
+    def decode(self, raw, legacy):
+        if raw[:1] not in ("o", "n"):
+            raise ValueError(raw)
+        return raw[0], int(raw[1:], 10 if legacy else 36)
+
+CB_INT = CbInt()
+CB_STR = CbStr(16)
+CB_CURSOR = CbCursor()
+
+class CallbackRouter:
+    def __init__(self):
+        self._by_name = {}
+        self._by_code = {}
+
+    def add(self, name, code, handler, fields=(), admin=False):
+        if not code or code[0].isdigit() or ":" in code or ":" in name:
+            raise ValueError(f"bad callback route {name!r}/{code!r}")
+        if name in self._by_name or code in self._by_code:
+            raise ValueError(f"callback route collision: {name!r}/{code!r}")
+        route = (name, code, handler, tuple(fields), admin)
+        self._by_name[name] = route
+        self._by_code[code] = route
+
+    def encode(self, name, *args):
+        _name, code, _handler, fields, _admin = self._by_name[name]
+        if len(args) > len(fields):
+            raise ValueError(f"too many callback args for {name!r}")
+        data = ":".join([CALLBACK_VERSION + code] + [f.encode(a) for f, a in zip(fields, args)])
+        if len(data.encode()) > CALLBACK_DATA_MAX:
+            raise ValueError(f"callback_data too long for {name!r}: {data!r}")
+        return data
+
+    def decode(self, data):
+        # (route, args) أو None لبيانات غير معروفة/تالفة. الوسائط الناقصة من الآخر = None
+        if not data:
+            return None
+        legacy = not data[0].isdigit()
+        if legacy:
+            key, *raw = data.split(":")
+            route = self._by_name.get(key)
+        elif data[0] == CALLBACK_VERSION:
+            key, *raw = data[1:].split(":")
+            route = self._by_code.get(key)
+        else:
+            return None
+        if route is None or len(raw) > len(route[3]):
+            return None
+        try:
+            args = [f.decode(r, legacy) for f, r in zip(route[3], raw)]
+        except (ValueError, IndexError):
+            return None
+        return route, args + [None] * (len(route[3]) - len(raw))
+
+    def check(self):
+        # عند الإقلاع: كل مسار بأطول قيم ممكنة يجب أن يبقى ضمن 64 بايت ويُفك لنفسه
+        for name, _code, _handler, fields, _admin in self._by_name.values():
+            data = self.encode(name, *(f.sample for f in fields))
+            if self.decode(data)[0][0] != name:
+                raise ValueError(f"callback route {name!r} does not round-trip")
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        decoded = self.decode(q.data)
+        if decoded is None or decoded[0][2] is None:
+            metrics.inc("bot_callbacks_unknown_total")
+            await q.answer("زر غير مفعل بعد.")
+            return
+        (name, _code, handler, _fields, admin), args = decoded
+        if admin and q.from_user.id != ADMIN_ID:
+            await q.answer("🚫 غير مصرح.", show_alert=True)
+            return
+        if q.inline_message_id:
+            # رسالة مضمّنة مشتركة: مسارات INLINE_ROUTES وحدها، وهي ترد على الضغطة بنفسها
+            if name not in INLINE_ROUTES:
+                await q.answer("افتح البوت للمتابعة.", show_alert=True)
+                return
+        else:
+            await q.answer()
+        t = time.perf_counter()
+        try:
+            await handler(update, context, *args)
+        finally:
+            metrics.observe("bot_callback_seconds", time.perf_counter() - t, route=name)
+
+
+callbacks = CallbackRouter()
+cbdata = callbacks.encode
 
 # === أوامر وواجهات البوت ===
 
 # توليد لوحة رئيسية للمستخدم
 def main_menu_keyboard():
     kb = [
-        [InlineKeyboardButton("🛍️ تصفّح الأقسام", callback_data="browse_sections")],
-        [InlineKeyboardButton("💰 رصيدي", callback_data="show_balance"),
-         InlineKeyboardButton("📄 طلباتي", callback_data="my_orders")],
-        [InlineKeyboardButton("🔔 إشعارات", callback_data="subscriptions")]
+        [InlineKeyboardButton("🛍️ تصفّح الأقسام", callback_data=cbdata("browse_sections")),
+         InlineKeyboardButton("🔍 بحث", switch_inline_query_current_chat="")],
+        [InlineKeyboardButton("💰 رصيدي", callback_data=cbdata("show_balance")),
+         InlineKeyboardButton("📄 طلباتي", callback_data=cbdata("my_orders"))],
+        [InlineKeyboardButton("🔔 إشعارات", callback_data=cbdata("subscriptions"))]
+    ]
+    return InlineKeyboardMarkup(kb)
+
+# لوحة أدمن (شفافة مظهرًا باستخدام emoji وInlineKeyboard)
+def admin_panel_keyboard():
+    kb = [
+        [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data=cbdata("admin_users"))],
+        [InlineKeyboardButton("🛒 إدارة المتجر", callback_data=cbdata("admin_store"))],
+        [InlineKeyboardButton("🧾 الطلبات المعلقة", callback_data=cbdata("admin_orders_pending"))],
+        [InlineKeyboardButton("📊 الإحصائيات", callback_data=cbdata("admin_stats"))],
+        [InlineKeyboardButton("✉️ الرسائل والإعلانات", callback_data=cbdata("admin_messages"))],
+        [InlineKeyboardButton("⚙️ إعدادات عامة", callback_data=cbdata("admin_settings"))],
     ]
     return InlineKeyboardMarkup(kb)
 
-# لوحة أدمن (شفافة مظهرًا باستخدام emoji وInlineKeyboard)
-def admin_panel_keyboard():
-    kb = [
-        [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data="admin_users")],
-        [InlineKeyboardButton("🛒 إدارة المتجر", callback_data="admin_store")],
-        [InlineKeyboardButton("✉️ الرسائل والإعلانات", callback_data="admin_messages")],
-        [InlineKeyboardButton("⚙️ إعدادات عامة", callback_data="admin_settings")],
-    ]
-    return InlineKeyboardMarkup(kb)
+# === لقطة الكتالوج (catalog snapshot) ===
+# نص ولوحة قائمة الأقسام وكل قسم تُبنى مرة واحدة وتُعاد لكل المستخدمين.
+# تُلغى بدقة من create_section/create_product/delete_section/delete_product.
+
+def render_sections_view(sections):
+    if not sections:
+        return "لا توجد أقسام حالياً. تواصل مع الدعم.", main_menu_keyboard()
+    kb = []
+    for s_id, name in sections:
+        kb.append([InlineKeyboardButton(name, callback_data=cbdata("section", s_id))])
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("main_back"))])
+    return "📚 الأقسام:", InlineKeyboardMarkup(kb)
+
+PHOTO_CAPTION_MAX = 1024  # حد Telegram لتعليق الصورة
+
+def render_section_view(section_id, products, currency):
+    # (text, markup, views) حيث views = {pid: (text, markup, image_url)} لعرض كل منتج
+    back = [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("browse_sections"))]
+    if not products:
+        return "لا توجد منتجات في هذا القسم.", InlineKeyboardMarkup([back]), {}
+    text = "🛍️ منتجات القسم:\n"
+    kb = []
+    views = {}
+    to_section = [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("section", section_id))]
+    for pid, name, price, desc, image_url in products:
+        text += f"\n• {name} — {price} {currency}"
+        kb.append([InlineKeyboardButton(name, callback_data=cbdata("product", pid))])
+        detail = f"{name} — {price} {currency}" + (f"\n\n{desc}" if desc else "")
+        if image_url:
+            detail = detail[:PHOTO_CAPTION_MAX]
+        views[pid] = (detail, InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"🛒 شراء — {price} {currency}", callback_data=cbdata("buy", pid))], to_section]),
+            image_url)
+    kb.append(back)
+    return text, InlineKeyboardMarkup(kb), views
+
+class CatalogCache:
+    def __init__(self):
+        self._sections_view = None
+        self._section_views = {}
+        self._product_views = {}  # pid -> عرض المنتج، من لقطة قسمه
+        # يزيد مع كل إلغاء؛ بناء بدأ قبل الإلغاء لا يُخزَّن (حتى لا تعود نسخة قديمة)
+        self._gen = 0
+
+    def invalidate(self, section_id=None, sections=False):
+        # بدون وسائط: إلغاء كل شيء، هنا وفي باقي العمليات العاملة
+        self.drop(section_id, sections)
+        cluster.publish("catalog", section_id, sections)
+
+    def drop(self, section_id=None, sections=False):
+        self._gen += 1
+        if section_id is None and not sections:
+            self._sections_view = None
+            self._section_views.clear()
+            self._product_views.clear()
+            return
+        if sections:
+            self._sections_view = None
+        if section_id is not None:
+            view = self._section_views.pop(section_id, None)
+            for pid in view[2] if view else ():
+                self._product_views.pop(pid, None)
+
+    async def sections_view(self):
+        view = self._sections_view
+        if view is None:
+            gen = self._gen
+            view = render_sections_view(await list_sections())
+            if gen == self._gen:
+                self._sections_view = view
+        return view
+
+    async def section_view(self, section_id):
+        view = self._section_views.get(section_id)
+        if view is None:
+            gen = self._gen
+            view = render_section_view(section_id, await list_products(section_id), settings.currency)
+            if gen == self._gen:
+                self._section_views[section_id] = view
+                self._product_views.update(view[2])
+        return view
+
+    async def product_view(self, product_id):
+        # None = غير موجود أو مخفي
+        view = self._product_views.get(product_id)
+        if view is None:
+            product = await get_product(product_id)
+            if product is None:
+                return None
+            view = (await self.section_view(product[1]))[2].get(product_id)
+        return view
+
+    async def warm(self):
+        for s_id, _name in await list_sections():
+            await self.section_view(s_id)
+        await self.sections_view()
+
+
+catalog = CatalogCache()
+
+# === كاش صور المنتجات (file_id) ===
+# أول عرض لصورة يرسلها عبر image_url فيجلبها Telegram مرة واحدة، ونحفظ file_id الناتج في
+# products.image_file_id ونعيد استخدامه لكل عرض لاحق. العروض المتزامنة لنفس المنتج أثناء
+# الرفع الأول تنتظره بدل رفع ثانٍ. file_id مرفوض من Telegram (BadRequest) يُنسى ويُعاد الرفع.
+
+class MediaCache:
+    def __init__(self):
+        self._file_ids = {}   # pid -> (image_url, file_id)
+        self._inflight = {}   # pid -> Future ينتهي بانتهاء الرفع الأول
+        self._tasks = set()
+
+    def forget(self, product_id):
+        self._file_ids.pop(product_id, None)
+
+    async def _claim(self, product_id, image_url, stored=True):
+        # يعيد file_id إن وُجد؛ وإلا يسجّل المستدعي رافعاً وحيداً لهذا المنتج (عليه استدعاء _release).
+        # stored=False: تجاهل file_id المخزن (رفضه Telegram) وارفع من جديد
+        while product_id in self._inflight:
+            await asyncio.shield(self._inflight[product_id])
+        if not stored:
+            self._inflight[product_id] = asyncio.get_running_loop().create_future()
+            return None
+        entry = self._file_ids.get(product_id)
+        if entry and entry[0] == image_url:
+            metrics.inc("bot_media_cache_total", result="hit")
+            return entry[1]
+        self._inflight[product_id] = asyncio.get_running_loop().create_future()
+        try:
+            row = await get_product_image(product_id)
+        except BaseException:
+            # بدون هذا يبقى Future معلقاً وينتظره كل طالب لهذا المنتج إلى الأبد
+            self._release(product_id)
+            raise
+        if row and row[0] == image_url and row[1]:
+            self._file_ids[product_id] = row
+            self._release(product_id)
+            metrics.inc("bot_media_cache_total", result="hit")
+            return row[1]
+        metrics.inc("bot_media_cache_total", result="miss")
+        return None
+
+    def _release(self, product_id):
+        fut = self._inflight.pop(product_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    async def _remember(self, product_id, image_url, message):
+        file_id = message.photo[-1].file_id
+        self._file_ids[product_id] = (image_url, file_id)
+        await save_image_file_id(product_id, image_url, file_id)
+        metrics.inc("bot_media_uploads_total")
+
+    async def send_photo(self, bot, chat_id, product_id, image_url, caption=None, reply_markup=None):
+        file_id = await self._claim(product_id, image_url)
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup)
+            except BadRequest:
+                self.forget(product_id)
+                await self._claim(product_id, image_url, stored=False)
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption, reply_markup=reply_markup)
+            await self._remember(product_id, image_url, message)
+            return message
+        finally:
+            self._release(product_id)
+
+    def prefetch(self, bot, product_id, image_url):
+        # عند تعيين الأدمن لصورة: نرسلها له في الخلفية فيجلبها Telegram ويتحقق منها، ونحفظ file_id
+        async def run():
+            api_priority.set(PRIORITY_TRANSACTIONAL)
+            try:
+                await self.send_photo(bot, ADMIN_ID, product_id, image_url, caption=f"✅ صورة المنتج {product_id} جاهزة.")
+            except TelegramError as e:
+                metrics.inc("bot_media_prefetch_failed_total")
+                try:
+                    await bot.send_message(chat_id=ADMIN_ID, text=f"⚠️ تعذر جلب صورة المنتج {product_id}: {e.message}\nتأكد من الرابط.")
+                except TelegramError:
+                    pass
+        task = asyncio.get_running_loop().create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+media_cache = MediaCache()
+
+# === بوابة قبل كل الـ handlers ===
+# يستدعيها OrderedApplication.process_update قبل قفل المستخدم ومقعد التزامن، لكل أنواع
+# التحديثات: رسائل، أزرار، وغيرها. المحظور ومن تجاوز حد الإغراق يُرد عليهما بأرخص شكل
+# ويُسقط التحديث، فلا ينتظر خلف تحديثات نفس المستخدم ولا يحجز مقعداً. القبول = بحث في
+# set وtoken bucket بالذاكرة، بدون أي استعلام DB.
+
+# مسارات الأزرار التي تكتب في DB أو تستعلم لكل ضغطة: ميزانية الكتابة الأضيق
+FLOOD_WRITE_ROUTES = {"buy", "show_balance"}
+
+class FloodGuard:
+    # لكل مستخدم bucket للقراءة (تصفح، بحث، رسائل) وbucket للكتابة (FLOOD_WRITE_ROUTES)،
+    # وbucket "مخالفات" بسعة strikes يُفرغ بكل تحديث مرفوض ويمتلئ خلال window: إفراغه
+    # يعني إغراقاً مستمراً لا ضغطات متحمسة، فيُحظر المستخدم. الذاكرة محدودة بـ max_users
+    # لكل bucket، ويُطرد الأقدم نشاطاً (LRU) فيبدأ من جديد بميزانية كاملة.
+
+    def __init__(self, read_rate, read_burst, write_rate, write_burst, strikes, window, max_users):
+        self.reads = KeyedRateLimiter(read_rate, read_burst, max_users)
+        self.writes = KeyedRateLimiter(write_rate, write_burst, max_users)
+        self.strikes = KeyedRateLimiter(strikes / window, strikes, max_users) if strikes else None
+
+    def allow(self, user_id, write=False):
+        return (self.writes if write else self.reads).try_acquire(user_id)
+
+    def strike(self, user_id):
+        # True = تجاوز حد المخالفات ويجب الحظر
+        return self.strikes is not None and not self.strikes.try_acquire(user_id)
+
+
+flood_guard = FloodGuard(FLOOD_READ_RATE, FLOOD_READ_BURST, FLOOD_WRITE_RATE, FLOOD_WRITE_BURST,
+                         FLOOD_BAN_STRIKES, FLOOD_BAN_WINDOW, FLOOD_MAX_USERS)
+
+def is_write_update(update):
+    q = update.callback_query
+    if q is None:
+        return False
+    decoded = callbacks.decode(q.data)
+    return decoded is not None and decoded[0][0] in FLOOD_WRITE_ROUTES
+
+async def admit(update):
+    # True = يُعالج التحديث؛ False = أُسقط (ورُد عليه إن لزم)
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return True
+    if user.id not in banned_ids:
+        write = is_write_update(update)
+        if flood_guard.allow(user.id, write):
+            return True
+        metrics.inc("bot_gate_dropped_total", reason="flood_write" if write else "flood_read")
+        if not flood_guard.strike(user.id):
+            # فوق الحد: answer() فقط للأزرار (حتى لا يبقى مؤشر التحميل) بدون أي عمل في DB
+            if update.callback_query:
+                try:
+                    await update.callback_query.answer("⏳ تمهّل قليلاً ثم أعد المحاولة.")
+                except TelegramError:
+                    pass
+            return False
+        # إغراق مستمر: حظر في جدول bans، ويصله رد الحظر أدناه. الإضافة إلى banned_ids قبل
+        # انتظار DB حتى لا تحظره تحديثاته المتزامنة مرة أخرى
+        banned_ids.add(user.id)
+        await ban_user(user.id, "flood")
+        metrics.inc("bot_flood_bans_total")
+        logger.warning("User %d banned automatically for flooding", user.id)
+    elif not flood_guard.allow(user.id):
+        # محظور يُغرق: لا نرد على كل تحديث
+        metrics.inc("bot_gate_dropped_total", reason="banned")
+        return False
+    metrics.inc("bot_gate_dropped_total", reason="banned")
+    try:
+        if update.callback_query:
+            await update.callback_query.answer("🚫 حسابك محظور.", show_alert=True)
+        elif update.message:
+            await update.message.reply_text("🚫 حسابك محظور. تواصل مع الدعم إذا كان هناك خطأ.")
+    except TelegramError:
+        pass
+    return False
 
 # الأمر /start
+@metrics.timed("bot_handler_seconds", "handler")
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     username = user.username or user.full_name
-    ensure_user(user_id, username)
-    if is_banned(user_id):
-        await update.message.reply_text("🚫 حسابك محظور. تواصل مع الدعم إذا كان هناك خطأ.")
-        return
-
-    welcome = load_setting("welcome_msg", "أهلاً بك!")
+    await ensure_user(user_id, username)
+    welcome = settings.welcome_msg
     await update.message.reply_text(welcome, reply_markup=main_menu_keyboard())
 
 # الأمر /admin
+@metrics.timed("bot_handler_seconds", "handler")
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id != ADMIN_ID:
@@ -250,329 +2535,413 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("لوحة الأدمن — تحكم كامل", reply_markup=admin_panel_keyboard())
 
 # Show balance handler
+@metrics.timed("bot_handler_seconds", "handler")
 async def show_balance_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
     user_id = q.from_user.id
-    bal = get_balance(user_id)
-    currency = load_setting("currency", "SYP")
+    bal = await get_balance(user_id)
+    currency = settings.currency
     await q.edit_message_text(f"💰 رصيدك: {bal} {currency}", reply_markup=main_menu_keyboard())
 
+# رجوع للقائمة الرئيسية
+@metrics.timed("bot_handler_seconds", "handler")
+async def main_back_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.edit_message_text(settings.welcome_msg, reply_markup=main_menu_keyboard())
+
+async def edit_view(q, text, reply_markup=None):
+    # عرض المنتج رسالة صورة ولا يمكن تعديلها إلى نص: نرسل النص رسالة جديدة ونحذف الصورة
+    msg = q.message
+    if msg is None or not msg.photo:
+        return await q.edit_message_text(text, reply_markup=reply_markup)
+    sent = await msg.chat.send_message(text, reply_markup=reply_markup)
+    try:
+        await msg.delete()
+    except TelegramError:
+        pass
+    return sent
+
 # Browse sections
+@metrics.timed("bot_handler_seconds", "handler")
 async def browse_sections_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
-    sections = list_sections()
-    if not sections:
-        await q.edit_message_text("لا توجد أقسام حالياً. تواصل مع الدعم.", reply_markup=main_menu_keyboard())
-        return
-    kb = []
-    for s_id, name in sections:
-        kb.append([InlineKeyboardButton(name, callback_data=f"section:{s_id}")])
-    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data="main_back")])
-    await q.edit_message_text("📚 الأقسام:", reply_markup=InlineKeyboardMarkup(kb))
+    text, markup = await catalog.sections_view()
+    await q.edit_message_text(text, reply_markup=markup)
 
 # Show section products
-async def section_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@metrics.timed("bot_handler_seconds", "handler")
+async def section_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, s_id):
     q = update.callback_query
-    await q.answer()
-    payload = q.data  # section:{id}
-    _, s_id = payload.split(":")
-    s_id = int(s_id)
-    products = list_products(s_id)
-    if not products:
-        await q.edit_message_text("لا توجد منتجات في هذا القسم.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="browse_sections")]]))
-        return
-    text = "🛍️ منتجات القسم:\n"
-    kb = []
-    for p in products:
-        pid, name, price, desc, image_url = p[0], p[2], p[3], p[4], p[5]
-        text += f"\n• {name} — {price} {load_setting('currency','SYP')}"
-        kb.append([InlineKeyboardButton(f"شراء {name}", callback_data=f"buy:{pid}")])
-    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data="browse_sections")])
-    await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    text, markup, _views = await catalog.section_view(s_id)
+    await edit_view(q, text, markup)
 
-# Buy product flow
-async def buy_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# عرض منتج: الوصف وزر الشراء، والصورة (إن وُجدت) مرة واحدة هنا بدل إرسالها مع كل عرض للقسم
+@metrics.timed("bot_handler_seconds", "handler")
+async def product_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, pid):
     q = update.callback_query
-    await q.answer()
-    _, pid = q.data.split(":")
-    pid = int(pid)
-    prod = get_product(pid)
-    if not prod:
-        await q.edit_message_text("المنتج غير موجود.", reply_markup=main_menu_keyboard())
+    view = await catalog.product_view(pid)
+    if view is None:
+        await edit_view(q, "المنتج غير موجود.", main_menu_keyboard())
         return
-    user_id = q.from_user.id
-    ensure_user(user_id)
-    # هنا نطلب تأكيد الطلب ونسجل طلب مؤقت أو مباشرة نرسله للأدمن
-    name = prod[2]
-    price = prod[3]
-    currency = load_setting("currency", "SYP")
-    # تخفيض VIP إن وجد
-    cur.execute("SELECT vip_level FROM users WHERE id=?", (user_id,))
-    r = cur.fetchone()
-    vip = r[0] if r else "None"
-    discount = 0
-    if vip == "Bronze":
-        # مثال: خفض 1%
-        discount = int(price * 0.01)
-    elif vip == "Silver":
-        discount = int(price * 0.02)
-    final_price = price - discount
-    # سجل الطلب في DB كـ pending
-    cur.execute("INSERT INTO orders (user_id, product_id, qty, total, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, pid, 1, final_price, "pending", now_ts()))
-    conn.commit()
-    order_id = cur.lastrowid
-    # أرسل للأدمن إشعار بالطلب
+    text, markup, image_url = view
+    if not image_url or q.message is None:
+        await edit_view(q, text, markup)
+        return
+    # لا يمكن تعديل رسالة نصية إلى صورة: نرسل الصورة (file_id من الكاش) ونحذف القائمة
     try:
-        admin_msg = f"طلب جديد #{order_id}\nالمنتج: {name}\nالسعر: {final_price} {currency}\nالمستخدم: {q.from_user.id}"
-        await context.bot.send_message(chat_id=ADMIN_ID, text=admin_msg,
-                                       reply_markup=InlineKeyboardMarkup([
-                                           [InlineKeyboardButton("قبول", callback_data=f"admin_order_accept:{order_id}")],
-                                           [InlineKeyboardButton("رفض", callback_data=f"admin_order_reject:{order_id}")]
-                                       ]))
-    except Exception:
+        await media_cache.send_photo(context.bot, q.message.chat_id, pid, image_url, caption=text, reply_markup=markup)
+    except TelegramError as e:
+        logger.warning("Could not send photo for product %s: %s", pid, e)
+        await edit_view(q, text, markup)
+        return
+    try:
+        await q.message.delete()
+    except TelegramError:
         pass
-    await q.edit_message_text(f"✅ تم إرسال الطلب #{order_id} إلى الأدمن للمراجعة.\nالسعر: {final_price} {currency}", reply_markup=main_menu_keyboard())
 
-# Admin accepts order
-async def admin_order_accept_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Buy product flow
+@metrics.timed("bot_handler_seconds", "handler")
+async def buy_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, pid, nonce=None):
     q = update.callback_query
-    await q.answer()
-    if q.from_user.id != ADMIN_ID:
-        await q.edit_message_text("🚫 فقط الأدمن يمكنه تنفيذ هذا.")
+    user_id = q.from_user.id
+    await ensure_user(user_id)
+    status, order_id, name, final_price = await checkout(user_id, pid, checkout_key(q))
+    currency = settings.currency
+    if status == "not_found":
+        text = "المنتج غير موجود."
+    elif status == "sold_out":
+        text = f"❌ نفدت كمية {name}."
+    elif status == "insufficient":
+        balance = await get_balance(user_id)
+        text = f"❌ رصيدك غير كافٍ.\nالسعر: {final_price} {currency}\nرصيدك: {balance} {currency}"
+    else:
+        text = f"✅ تم إرسال الطلب #{order_id} إلى الأدمن للمراجعة.\nتم خصم {final_price} {currency} من رصيدك."
+    if status == "ok":
+        # إشعار الأدمن عبر الطابور (الضغطة المكررة لا تعيد الإشعار)
+        order_notifier.notify(context.bot, (order_id, user_id, name, final_price))
+        # الصورة إيصالاً، إلا إن كان الشراء من عرض المنتج الذي أظهرها للتو
+        image = None if q.message is not None and q.message.photo else await get_product_image(pid)
+        if image and image[0]:
+            try:
+                await media_cache.send_photo(context.bot, user_id, pid, image[0], caption=f"🧾 طلب #{order_id}: {name}")
+            except TelegramError as e:
+                logger.warning("Could not send photo for product %s: %s", pid, e)
+    if q.inline_message_id:
+        # بطاقة بحث مضمّن قد تكون في مجموعة يراها الجميع: النتيجة للضاغط وحده، والبطاقة تبقى
+        # بطاقة المنتج، مع nonce جديد بعد الشراء الناجح
+        await q.answer(text, show_alert=True)
+        if status == "ok":
+            product = await get_product(pid)
+            if product:
+                try:
+                    await q.edit_message_reply_markup(inline_buy_keyboard(pid, product[3], currency, order_id))
+                except TelegramError:
+                    pass
         return
-    _, action = q.data.split(":")
-    # format: admin_order_accept:{order_id}
-    parts = q.data.split(":")
-    order_id = int(parts[1])
-    # استعلام order
-    cur.execute("SELECT user_id, product_id, total FROM orders WHERE id=?", (order_id,))
-    row = cur.fetchone()
-    if not row:
-        await q.edit_message_text("الطلب غير موجود.")
+    await edit_view(q, text, reply_markup=main_menu_keyboard())
+
+# Admin accepts order
+@metrics.timed("bot_handler_seconds", "handler")
+async def admin_order_accept_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id):
+    q = update.callback_query
+    # المبلغ خُصم عند الشراء؛ القبول يغيّر الحالة فقط (ومرة واحدة)
+    user_id = await settle_order(order_id, "accepted")
+    if user_id is None:
+        await q.edit_message_text(f"الطلب #{order_id} غير موجود أو تمت معالجته مسبقاً.")
         return
-    user_id, pid, total = row
-    # خصم الرصيد إن اعتمدنا الدفع من رصيد البوت (هنا افتراضي يدوي) -> نقوم فقط بتحديث الحالة
-    cur.execute("UPDATE orders SET status='accepted' WHERE id=?", (order_id,))
-    conn.commit()
-    # إبلاغ المستخدم
-    try:
-        await context.bot.send_message(chat_id=user_id, text=f"✅ طلبك #{order_id} قُبِل. شكراً لك.")
-    except Exception:
-        pass
     await q.edit_message_text(f"تم قبول الطلب #{order_id} بنجاح.")
+    # إبلاغ المستخدم بعد رد الأدمن في الخلفية (من عامله المالك)، فلا يؤخر الإشعار واجهته
+    order_notifier.tell_users(context.bot, [(user_id, f"✅ طلبك #{order_id} قُبِل. شكراً لك.")])
 
 # Admin rejects order
-async def admin_order_reject_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@metrics.timed("bot_handler_seconds", "handler")
+async def admin_order_reject_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id):
     q = update.callback_query
-    await q.answer()
-    if q.from_user.id != ADMIN_ID:
-        await q.edit_message_text("🚫 فقط الأدمن يمكنه تنفيذ هذا.")
+    # الرفض يعيد المبلغ المدفوع إلى الرصيد ويعيد القطعة إلى المخزون
+    user_id = await settle_order(order_id, "rejected")
+    if user_id is None:
+        await q.edit_message_text(f"الطلب #{order_id} غير موجود أو تمت معالجته مسبقاً.")
         return
-    parts = q.data.split(":")
-    order_id = int(parts[1])
-    cur.execute("UPDATE orders SET status='rejected' WHERE id=?", (order_id,))
-    conn.commit()
-    cur.execute("SELECT user_id FROM orders WHERE id=?", (order_id,))
-    row = cur.fetchone()
-    if row:
-        user_id = row[0]
-        try:
-            await context.bot.send_message(chat_id=user_id, text=f"❌ طلبك #{order_id} رُفِض.")
-        except Exception:
-            pass
     await q.edit_message_text(f"تم رفض الطلب #{order_id}.")
+    order_notifier.tell_users(context.bot, [(user_id, f"❌ طلبك #{order_id} رُفِض وأُعيد المبلغ إلى رصيدك.")])
 
-# Admin panel callbacks
-async def admin_panel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# الطلبات المعلقة ورسائل الـ digest: قبول الكل / رفض المحدد
+@metrics.timed("bot_handler_seconds", "handler")
+async def admin_orders_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, oid=None, *, action):
+    # action: pending / toggle / accept / reject
     q = update.callback_query
-    await q.answer()
-    if q.from_user.id != ADMIN_ID:
-        await q.edit_message_text("🚫 غير مصرح.")
-        return
-    data = q.data
-    if data == "admin_users":
-        # عرض المستخدمين (مختصر)
-        rows = list_users()
-        if not rows:
-            await q.edit_message_text("لا يوجد مستخدمين.", reply_markup=admin_panel_keyboard())
-            return
-        text = "👥 قائمة المستخدمين:\n\n"
-        kb = []
-        for uid, uname, bal, vip in rows[:30]:  # نعرض أول 30 لتفادي الطوالة
-            uname_display = uname or ""
-            text += f"• {uname_display} — ID: {uid} — {bal} {load_setting('currency')}\n"
-            kb.append([InlineKeyboardButton(f"إدارة {uid}", callback_data=f"admin_user:{uid}")])
-        kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data="admin_back")])
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-    elif data == "admin_store":
-        kb = [
-            [InlineKeyboardButton("➕ إضافة قسم", callback_data="admin_add_section")],
-            [InlineKeyboardButton("📝 عرض الأقسام", callback_data="admin_list_sections")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_back")]
-        ]
-        await q.edit_message_text("🛒 إدارة المتجر:", reply_markup=InlineKeyboardMarkup(kb))
-    elif data == "admin_messages":
-        kb = [
-            [InlineKeyboardButton("✏️ تعديل رسالة الترحيب", callback_data="admin_edit_welcome")],
-            [InlineKeyboardButton("📢 بث رسالة", callback_data="admin_broadcast")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_back")]
-        ]
-        await q.edit_message_text("✉️ الرسائل:", reply_markup=InlineKeyboardMarkup(kb))
-    elif data == "admin_settings":
-        kb = [
-            [InlineKeyboardButton("🔁 تبديل عملة / إعدادات", callback_data="admin_currency")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_back")]
-        ]
-        await q.edit_message_text("⚙️ إعدادات عامة:", reply_markup=InlineKeyboardMarkup(kb))
-    elif data == "admin_back":
-        await q.edit_message_text("لوحة الأدمن — تحكم كامل", reply_markup=admin_panel_keyboard())
-    elif data == "admin_list_sections":
-        rows = list_sections(only_visible=False)
-        if not rows:
-            await q.edit_message_text("لا توجد أقسام.", reply_markup=admin_panel_keyboard())
-            return
-        kb = []
-        text = "الأقسام:\n"
-        for sid, name, visible in rows:
-            vis = "مرئي" if visible else "مخفي"
-            text += f"• [{sid}] {name} — {vis}\n"
-            kb.append([InlineKeyboardButton(f"قسم {sid}", callback_data=f"admin_section_manage:{sid}")])
-        kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data="admin_store")])
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-    elif data.startswith("admin_section_manage:"):
-        _, sid = data.split(":")
-        sid = int(sid)
-        # عرض منتجات القسم وإمكانية تعديل
-        cur.execute("SELECT name, visible FROM sections WHERE id=?", (sid,))
-        row = cur.fetchone()
-        if not row:
-            await q.edit_message_text("القسم غير موجود.", reply_markup=admin_panel_keyboard())
-            return
-        name, visible = row
-        kb = [
-            [InlineKeyboardButton("➕ إضافة منتج", callback_data=f"admin_add_product:{sid}")],
-            [InlineKeyboardButton("📝 قائمة المنتجات", callback_data=f"admin_list_products:{sid}")],
-            [InlineKeyboardButton("❌ حذف القسم", callback_data=f"admin_delete_section:{sid}")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_list_sections")]
-        ]
-        await q.edit_message_text(f"قسم: {name} (ID: {sid})", reply_markup=InlineKeyboardMarkup(kb))
-    elif data.startswith("admin_list_products:"):
-        _, sid = data.split(":")
-        sid = int(sid)
-        prods = list_products(sid, only_visible=False)
-        text = f"منتجات القسم {sid}:\n"
-        kb = []
-        if not prods:
-            text += "لا توجد منتجات."
-        else:
-            for p in prods:
-                pid = p[0]
-                name = p[2]
-                price = p[3]
-                vis = "مرئي" if p[4] else "مخفي"
-                text += f"• [{pid}] {name} — {price} {load_setting('currency')} — {vis}\n"
-                kb.append([InlineKeyboardButton(f"منتج {pid}", callback_data=f"admin_product_manage:{pid}")])
-        kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=f"admin_section_manage:{sid}")])
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-    elif data.startswith("admin_product_manage:"):
-        _, pid = data.split(":")
-        pid = int(pid)
-        prod = get_product(pid)
-        if not prod:
-            await q.edit_message_text("المنتج غير موجود.", reply_markup=admin_panel_keyboard())
+    if action == "pending":
+        orders = await list_pending_orders()
+        if not orders:
+            await q.edit_message_text("لا توجد طلبات معلقة.", reply_markup=admin_panel_keyboard())
             return
-        name = prod[2]
-        price = prod[3]
-        kb = [
-            [InlineKeyboardButton("تعديل الاسم", callback_data=f"admin_edit_product_name:{pid}")],
-            [InlineKeyboardButton("تعديل السعر", callback_data=f"admin_edit_product_price:{pid}")],
-            [InlineKeyboardButton("حذف المنتج", callback_data=f"admin_delete_product:{pid}")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_store")]
-        ]
-        await q.edit_message_text(f"المنتج [{pid}] {name}\nالسعر: {price}", reply_markup=InlineKeyboardMarkup(kb))
-    elif data == "admin_add_section":
-        # نضع حالة انتظار رسالة لادخال اسم القسم
-        await q.edit_message_text("أرسل اسم القسم الجديد الآن (أو ألغِ).")
-        context.user_data["admin_action"] = "add_section"
-    elif data.startswith("admin_add_product:"):
-        # اطلب من الأدمن تفاصيل المنتج (بصيغة: اسم | سعر | وصف اختياري)
-        _, sid = data.split(":")
-        context.user_data["admin_action"] = "add_product"
-        context.user_data["admin_section"] = int(sid)
-        await q.edit_message_text("أرسل تفاصيل المنتج بصيغة:\nالاسم | السعر | الوصف (الصور والازرار لاحقاً).")
-    elif data.startswith("admin_delete_section:"):
-        _, sid = data.split(":")
-        sid = int(sid)
-        cur.execute("DELETE FROM sections WHERE id=?", (sid,))
-        cur.execute("DELETE FROM products WHERE section_id=?", (sid,))
-        conn.commit()
-        await q.edit_message_text(f"تم حذف القسم {sid} وكل منتجاته.", reply_markup=admin_panel_keyboard())
-    elif data.startswith("admin_delete_product:"):
-        _, pid = data.split(":")
-        pid = int(pid)
-        cur.execute("DELETE FROM products WHERE id=?", (pid,))
-        conn.commit()
-        await q.edit_message_text(f"تم حذف المنتج {pid}.", reply_markup=admin_panel_keyboard())
-    elif data == "admin_edit_welcome":
-        await q.edit_message_text("أرسل النص الجديد لرسالة الترحيب الآن.")
-        context.user_data["admin_action"] = "edit_welcome"
-    elif data == "admin_broadcast":
-        await q.edit_message_text("أرسل رسالة البث الآن. (سيتم إرسالها لكل المستخدمين المسجلين)")
-        context.user_data["admin_action"] = "broadcast"
-    elif data == "admin_currency":
-        await q.edit_message_text("أرسل رمز العملة الجديد (مثال SYP).")
-        context.user_data["admin_action"] = "set_currency"
-    elif data.startswith("admin_user:"):
-        _, uid = data.split(":")
-        uid = int(uid)
-        # إظهار خيارات إدارة مستخدم
-        kb = [
-            [InlineKeyboardButton("➕ إضافة رصيد", callback_data=f"admin_user_add:{uid}")],
-            [InlineKeyboardButton("➖ خصم رصيد", callback_data=f"admin_user_sub:{uid}")],
-            [InlineKeyboardButton("🔄 تصفير رصيد", callback_data=f"admin_user_reset:{uid}")],
-            [InlineKeyboardButton("🚫 حظر", callback_data=f"admin_user_ban:{uid}")],
-            [InlineKeyboardButton("✅ فك الحظر", callback_data=f"admin_user_unban:{uid}")],
-            [InlineKeyboardButton("✉️ إرسال رسالة", callback_data=f"admin_user_msg:{uid}")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="admin_users")]
-        ]
-        await q.edit_message_text(f"إدارة المستخدم {uid}:", reply_markup=InlineKeyboardMarkup(kb))
-    elif data.startswith("admin_user_add:"):
-        _, uid = data.split(":")
-        context.user_data["admin_action"] = "user_add_balance"
-        context.user_data["admin_target"] = int(uid)
-        await q.edit_message_text(f"أدخل المبلغ الذي تريد إضافته للمستخدم {uid}:")
-    elif data.startswith("admin_user_sub:"):
-        _, uid = data.split(":")
-        context.user_data["admin_action"] = "user_sub_balance"
-        context.user_data["admin_target"] = int(uid)
-        await q.edit_message_text(f"أدخل المبلغ الذي تريد خصمه من المستخدم {uid}:")
-    elif data.startswith("admin_user_reset:"):
-        _, uid = data.split(":")
-        uid = int(uid)
-        set_balance(uid, 0)
-        await q.edit_message_text(f"تم تصفير رصيد المستخدم {uid}.", reply_markup=admin_panel_keyboard())
-    elif data.startswith("admin_user_ban:"):
-        _, uid = data.split(":")
-        uid = int(uid)
-        ban_user(uid, reason="banned by admin")
-        await q.edit_message_text(f"تم حظر المستخدم {uid}.", reply_markup=admin_panel_keyboard())
-    elif data.startswith("admin_user_unban:"):
-        _, uid = data.split(":")
-        uid = int(uid)
-        unban_user(uid)
-        await q.edit_message_text(f"تم فك حظر المستخدم {uid}.", reply_markup=admin_panel_keyboard())
-    elif data.startswith("admin_user_msg:"):
-        _, uid = data.split(":")
-        context.user_data["admin_action"] = "send_msg_to_user"
-        context.user_data["admin_target"] = int(uid)
-        await q.edit_message_text(f"اكتب الرسالة التي تريد إرسالها للمستخدم {uid}:")
+        text, markup = render_order_digest(orders)
+        await q.edit_message_text(text, reply_markup=markup)
+        return
+    ids, selected = order_digest_state(q.message.reply_markup if q.message else None)
+    summary = ""
+    if action == "toggle":
+        selected ^= {oid}
+    elif action == "accept":
+        settled = await settle_orders([oid for oid in ids if oid not in selected], "accepted")
+        order_notifier.tell_users(context.bot, [(uid, f"✅ طلبك #{oid} قُبِل. شكراً لك.") for oid, uid in settled])
+        summary = f"تم قبول {len(settled)} طلب."
+    elif action == "reject":
+        settled = await settle_orders(sorted(selected), "rejected")
+        order_notifier.tell_users(context.bot, [(uid, f"❌ طلبك #{oid} رُفِض وأُعيد المبلغ إلى رصيدك.") for oid, uid in settled])
+        summary = f"تم رفض {len(settled)} طلب."
+    # إعادة الرسم مما بقي معلقاً فعلاً (قد يكون بعضه عولج من رسالة أخرى)
+    orders = await list_pending_orders(ids)
+    if not orders:
+        await q.edit_message_text(f"{summary}\nلا توجد طلبات معلقة متبقية في هذه الرسالة.".strip(),
+                                  reply_markup=admin_panel_keyboard())
+        return
+    text, markup = render_order_digest(orders, selected)
+    if summary:
+        text = f"{summary}\n\n{text}"
+    await q.edit_message_text(text, reply_markup=markup)
+
+# تصفح المستخدمين للأدمن (مقسّم لصفحات)
+USER_FILTER_LABELS = {"all": "الكل", "banned": "المحظورون", "vip": "VIP", "balance": "لديهم رصيد"}
+
+def render_users_list(title, rows, nav=None):
+    currency = settings.currency
+    text = title
+    kb = []
+    for uid, uname, bal, vip, *_keys in rows:
+        vip_display = f" — {vip}" if vip and vip != "None" else ""
+        text += f"• {uname or ''} — ID: {uid} — {bal} {currency}{vip_display}\n"
+        kb.append([InlineKeyboardButton(f"إدارة {uid}", callback_data=cbdata("admin_user", uid))])
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("🔍 بحث", callback_data=cbdata("admin_users_search"))] +
+              [InlineKeyboardButton(label, callback_data=cbdata("admin_users_filter", key))
+               for key, label in USER_FILTER_LABELS.items() if key != "all"])
+    kb.append([InlineKeyboardButton("👥 الكل", callback_data=cbdata("admin_users_filter", "all")),
+               InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_back"))])
+    return text, InlineKeyboardMarkup(kb)
+
+async def admin_users_view(context, page):
+    # مؤشرات الصفحات تُحفظ في user_data: pages[i] = نهاية الصفحة i-1 (None للأولى)
+    view = context.user_data.setdefault("admin_users_view", {"filter": "all", "pages": [None]})
+    pages = view["pages"]
+    page = max(0, min(page, len(pages) - 1))
+    rows = await list_users_page(view["filter"], pages[page], ADMIN_USERS_PAGE_SIZE + 1)
+    has_more = len(rows) > ADMIN_USERS_PAGE_SIZE
+    rows = rows[:ADMIN_USERS_PAGE_SIZE]
+    del pages[page + 1:]
+    if has_more:
+        last = rows[-1]
+        pages.append((last[-1], last[0]))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=cbdata("admin_users_page", page - 1)))
+    if has_more:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=cbdata("admin_users_page", page + 1)))
+    title = f"👥 المستخدمون ({USER_FILTER_LABELS[view['filter']]}) — صفحة {page + 1}:\n\n"
+    if not rows:
+        title += "لا يوجد مستخدمين.\n"
+    return render_users_list(title, rows, nav)
+
+# === أزرار لوحة الأدمن ===
+# كل زر دالة صغيرة في CALLBACK_ROUTES؛ التحقق من الأدمن والرد على الـ callback في الموزّع.
+
+def admin_prompt(action, prompt, target_key=None):
+    # زر يطلب إدخالاً نصياً من الأدمن: يضبط admin_action (وهدفه إن وُجد) ويعرض التعليمات
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE, target=None):
+        context.user_data["admin_action"] = action
+        if target_key:
+            context.user_data[target_key] = target
+        await update.callback_query.edit_message_text(prompt.format(target=target))
+    return handler
+
+async def admin_back_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text("لوحة الأدمن — تحكم كامل", reply_markup=admin_panel_keyboard())
+
+async def admin_users_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # عرض المستخدمين: الصفحة الأولى بالفلتر الحالي
+    text, markup = await admin_users_view(context, 0)
+    await update.callback_query.edit_message_text(text, reply_markup=markup)
+
+async def admin_users_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    text, markup = await admin_users_view(context, page or 0)
+    await update.callback_query.edit_message_text(text, reply_markup=markup)
+
+async def admin_users_filter_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, flt):
+    if flt not in USER_FILTERS:
+        flt = "all"
+    context.user_data["admin_users_view"] = {"filter": flt, "pages": [None]}
+    text, markup = await admin_users_view(context, 0)
+    await update.callback_query.edit_message_text(text, reply_markup=markup)
+
+async def admin_store_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    kb = [
+        [InlineKeyboardButton("➕ إضافة قسم", callback_data=cbdata("admin_add_section"))],
+        [InlineKeyboardButton("📝 عرض الأقسام", callback_data=cbdata("admin_list_sections"))],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_back"))]
+    ]
+    await update.callback_query.edit_message_text("🛒 إدارة المتجر:", reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_messages_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    kb = [
+        [InlineKeyboardButton("✏️ تعديل رسالة الترحيب", callback_data=cbdata("admin_edit_welcome"))],
+        [InlineKeyboardButton("📢 بث رسالة", callback_data=cbdata("admin_broadcast"))],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_back"))]
+    ]
+    await update.callback_query.edit_message_text("✉️ الرسائل:", reply_markup=InlineKeyboardMarkup(kb))
+
+STATS_PERIODS = ((1, "اليوم"), (7, "7 أيام"), (30, "30 يوماً"))
+
+def render_sales_stats(days, summary, currency):
+    (orders, _gross, accepted, revenue, rejected, refunded), sections, products = summary
+    label = dict(STATS_PERIODS).get(days, f"{days} يوم")
+    text = (f"📊 الإحصائيات — {label}\n\n"
+            f"الطلبات: {orders} (مقبولة {accepted}، مرفوضة {rejected}، معلقة {orders - accepted - rejected})\n"
+            f"الإيرادات: {revenue} {currency}\n"
+            f"المبالغ المعادة: {refunded} {currency}\n")
+    if sections:
+        text += "\n🗂 حسب القسم:\n"
+        for _sid, name, count, amount in sections:
+            text += f"• {name or 'قسم محذوف'}: {amount} {currency} ({count})\n"
+    if products:
+        text += "\n🏆 الأكثر مبيعاً:\n"
+        for i, (pid, name, count, amount) in enumerate(products, 1):
+            text += f"{i}. {name or f'منتج محذوف #{pid}'} — {amount} {currency} ({count})\n"
+    periods = [InlineKeyboardButton(("• " if d == days else "") + title, callback_data=cbdata("admin_stats", d))
+               for d, title in STATS_PERIODS]
+    kb = [periods, [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_back"))]]
+    return text, InlineKeyboardMarkup(kb)
+
+async def admin_stats_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, days=None):
+    days = days if days in dict(STATS_PERIODS) else 1
+    text, markup = render_sales_stats(days, await sales_summary(days), settings.currency)
+    try:
+        await update.callback_query.edit_message_text(text, reply_markup=markup)
+    except BadRequest:
+        pass  # نفس الأرقام (message is not modified)
+
+async def admin_settings_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    kb = [
+        [InlineKeyboardButton("🔁 تبديل عملة / إعدادات", callback_data=cbdata("admin_currency"))],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_back"))]
+    ]
+    await update.callback_query.edit_message_text("⚙️ إعدادات عامة:", reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_list_sections_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    rows = await list_sections(only_visible=False)
+    if not rows:
+        await q.edit_message_text("لا توجد أقسام.", reply_markup=admin_panel_keyboard())
+        return
+    kb = []
+    text = "الأقسام:\n"
+    for sid, name, visible in rows:
+        vis = "مرئي" if visible else "مخفي"
+        text += f"• [{sid}] {name} — {vis}\n"
+        kb.append([InlineKeyboardButton(f"قسم {sid}", callback_data=cbdata("admin_section_manage", sid))])
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_store"))])
+    await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_section_manage_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, sid):
+    q = update.callback_query
+    # عرض منتجات القسم وإمكانية تعديل
+    row = await get_section(sid)
+    if not row:
+        await q.edit_message_text("القسم غير موجود.", reply_markup=admin_panel_keyboard())
+        return
+    name, visible = row
+    kb = [
+        [InlineKeyboardButton("➕ إضافة منتج", callback_data=cbdata("admin_add_product", sid))],
+        [InlineKeyboardButton("📝 قائمة المنتجات", callback_data=cbdata("admin_list_products", sid))],
+        [InlineKeyboardButton("❌ حذف القسم", callback_data=cbdata("admin_delete_section", sid))],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_list_sections"))]
+    ]
+    await q.edit_message_text(f"قسم: {name} (ID: {sid})", reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_list_products_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, sid):
+    prods = await list_products(sid, only_visible=False)
+    currency = settings.currency
+    text = f"منتجات القسم {sid}:\n"
+    kb = []
+    if not prods:
+        text += "لا توجد منتجات."
     else:
-        await q.edit_message_text("زر غير معروف — أعد المحاولة.", reply_markup=admin_panel_keyboard())
+        for p in prods:
+            pid, name, price, _desc, visible = p
+            vis = "مرئي" if visible else "مخفي"
+            text += f"• [{pid}] {name} — {price} {currency} — {vis}\n"
+            kb.append([InlineKeyboardButton(f"منتج {pid}", callback_data=cbdata("admin_product_manage", pid))])
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_section_manage", sid))])
+    await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_product_manage_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, pid):
+    q = update.callback_query
+    prod = await get_product(pid)
+    if not prod:
+        await q.edit_message_text("المنتج غير موجود.", reply_markup=admin_panel_keyboard())
+        return
+    name = prod[2]
+    price = prod[3]
+    stock = prod[7]
+    kb = [
+        [InlineKeyboardButton("تعديل الاسم", callback_data=cbdata("admin_edit_product_name", pid))],
+        [InlineKeyboardButton("تعديل السعر", callback_data=cbdata("admin_edit_product_price", pid))],
+        [InlineKeyboardButton("تعديل المخزون", callback_data=cbdata("admin_edit_product_stock", pid))],
+        [InlineKeyboardButton("تعديل الصورة", callback_data=cbdata("admin_edit_product_image", pid))],
+        [InlineKeyboardButton("حذف المنتج", callback_data=cbdata("admin_delete_product", pid))],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_store"))]
+    ]
+    stock_display = "غير محدود" if stock is None else stock
+    await q.edit_message_text(f"المنتج [{pid}] {name}\nالسعر: {price}\nالمخزون: {stock_display}", reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_delete_section_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, sid):
+    await delete_section(sid)
+    await update.callback_query.edit_message_text(f"تم حذف القسم {sid} وكل منتجاته.", reply_markup=admin_panel_keyboard())
+
+async def admin_delete_product_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, pid):
+    await delete_product(pid)
+    await update.callback_query.edit_message_text(f"تم حذف المنتج {pid}.", reply_markup=admin_panel_keyboard())
+
+async def admin_user_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    # إظهار خيارات إدارة مستخدم
+    kb = [
+        [InlineKeyboardButton("➕ إضافة رصيد", callback_data=cbdata("admin_user_add", uid))],
+        [InlineKeyboardButton("➖ خصم رصيد", callback_data=cbdata("admin_user_sub", uid))],
+        [InlineKeyboardButton("🔄 تصفير رصيد", callback_data=cbdata("admin_user_reset", uid))],
+        [InlineKeyboardButton("📜 سجل الرصيد", callback_data=cbdata("admin_user_ledger", uid))],
+        [InlineKeyboardButton("🚫 حظر", callback_data=cbdata("admin_user_ban", uid))],
+        [InlineKeyboardButton("✅ فك الحظر", callback_data=cbdata("admin_user_unban", uid))],
+        [InlineKeyboardButton("✉️ إرسال رسالة", callback_data=cbdata("admin_user_msg", uid))],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_users"))]
+    ]
+    await update.callback_query.edit_message_text(f"إدارة المستخدم {uid}:", reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_user_reset_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    await set_balance(uid, 0)
+    await update.callback_query.edit_message_text(f"تم تصفير رصيد المستخدم {uid}.", reply_markup=admin_panel_keyboard())
+
+async def admin_user_ledger_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    rows = await list_ledger(uid)
+    currency = settings.currency
+    text = f"📜 آخر حركات رصيد المستخدم {uid}:\n"
+    if not rows:
+        text += "\nلا توجد حركات."
+    for _lid, delta, kind, ref, balance_after, created_at in rows:
+        ref_display = f" #{ref}" if ref else ""
+        text += f"\n{created_at[:16]} {kind}{ref_display}: {delta:+} → {balance_after} {currency}"
+    kb = [[InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("admin_user", uid))]]
+    await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+async def admin_user_ban_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    await ban_user(uid, reason="banned by admin")
+    await update.callback_query.edit_message_text(f"تم حظر المستخدم {uid}.", reply_markup=admin_panel_keyboard())
+
+async def admin_user_unban_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    await unban_user(uid)
+    await update.callback_query.edit_message_text(f"تم فك حظر المستخدم {uid}.", reply_markup=admin_panel_keyboard())
 
 # معالجة رسائل الأدمن في حالات الإدخال
+@metrics.timed("bot_handler_seconds", "handler")
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
@@ -583,7 +2952,7 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         return
     if action == "add_section":
         name = text
-        sid = create_section(name)
+        sid = await create_section(name)
         await update.message.reply_text(f"✅ تم إنشاء القسم '{name}' برقم ID: {sid}")
     elif action == "add_product":
         sid = context.user_data.get("admin_section")
@@ -599,49 +2968,82 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
                 context.user_data.pop("admin_action", None)
                 return
             desc = parts[2] if len(parts) >= 3 else ""
-            pid = create_product(sid, name, price, desc)
+            pid = await create_product(sid, name, price, desc)
             await update.message.reply_text(f"✅ تم إضافة المنتج '{name}' (ID: {pid}).")
+    elif action == "edit_product_name":
+        pid = context.user_data.get("admin_product")
+        await rename_product(pid, text)
+        await update.message.reply_text(f"✅ تم تغيير اسم المنتج {pid} إلى '{text}'.")
+    elif action == "edit_product_price":
+        pid = context.user_data.get("admin_product")
+        try:
+            price = int(text)
+        except ValueError:
+            await update.message.reply_text("السعر يجب أن يكون رقماً صحيحاً.")
+        else:
+            await set_product_price(pid, price)
+            await update.message.reply_text(f"✅ سعر المنتج {pid} أصبح {price}.")
+    elif action == "set_product_image":
+        pid = context.user_data.get("admin_product")
+        if text == "-":
+            await set_product_image(pid, "")
+            await update.message.reply_text(f"✅ أُزيلت صورة المنتج {pid}.")
+        elif not text.startswith(("http://", "https://")):
+            await update.message.reply_text("خطأ: أرسل رابطاً يبدأ بـ http:// أو https://")
+        else:
+            await set_product_image(pid, text)
+            await update.message.reply_text("⏳ تم حفظ الرابط، جاري التحقق من الصورة...")
+            media_cache.prefetch(context.bot, pid, text)
+    elif action == "set_product_stock":
+        pid = context.user_data.get("admin_product")
+        if text == "-":
+            await set_product_stock(pid, None)
+            await update.message.reply_text(f"✅ مخزون المنتج {pid} أصبح غير محدود.")
+        else:
+            try:
+                stock = int(text)
+            except ValueError:
+                await update.message.reply_text("خطأ: أرسل رقماً صحيحاً أو -.")
+            else:
+                await set_product_stock(pid, max(stock, 0))
+                await update.message.reply_text(f"✅ مخزون المنتج {pid}: {max(stock, 0)}.")
+    elif action == "search_users":
+        rows = await search_users(text)
+        title = f"🔍 نتائج البحث عن '{text}':\n\n"
+        if not rows:
+            title += "لا توجد نتائج.\n"
+        reply, markup = render_users_list(title, rows)
+        await update.message.reply_text(reply, reply_markup=markup)
     elif action == "edit_welcome":
-        save_setting("welcome_msg", text)
+        await save_setting("welcome_msg", text)
         await update.message.reply_text("✅ تم تحديث رسالة الترحيب.")
     elif action == "broadcast":
-        # أرسل الرسالة لكل المستخدمين في DB
-        cur.execute("SELECT id FROM users")
-        rows = cur.fetchall()
-        count = 0
-        for r in rows:
-            uid = r[0]
-            try:
-                await context.bot.send_message(chat_id=uid, text=text)
-                count += 1
-            except Exception:
-                pass
-        await update.message.reply_text(f"تم إرسال البث إلى {count} مستخدم(ـاً).")
+        # البث يعمل في الخلفية؛ التقدم والنتيجة تصل للأدمن كرسالة تُحدَّث
+        bid = await create_broadcast(text)
+        broadcaster.start(context.bot, bid)
+        await update.message.reply_text(f"📢 بدأ البث #{bid} في الخلفية. ستصلك تقارير التقدم هنا.")
     elif action == "set_currency":
-        save_setting("currency", text.upper())
+        await save_setting("currency", text.upper())
         await update.message.reply_text(f"✅ تم ضبط العملة إلى {text.upper()}.")
-    elif action == "user_add_balance":
+    elif action in ("user_add_balance", "user_sub_balance"):
         try:
             amount = int(text)
-            target = context.user_data.get("admin_target")
-            add_balance(target, amount)
-            await update.message.reply_text(f"✅ تم إضافة {amount} إلى المستخدم {target}.")
-        except Exception:
+        except ValueError:
             await update.message.reply_text("خطأ: أرسل رقماً صحيحاً.")
-    elif action == "user_sub_balance":
-        try:
-            amount = int(text)
+        else:
             target = context.user_data.get("admin_target")
-            add_balance(target, -amount)
-            await update.message.reply_text(f"✅ تم خصم {amount} من المستخدم {target}.")
-        except Exception:
-            await update.message.reply_text("خطأ: أرسل رقماً صحيحاً.")
+            if action == "user_add_balance":
+                await add_balance(target, amount, "admin_credit")
+                await update.message.reply_text(f"✅ تم إضافة {amount} إلى المستخدم {target}.")
+            else:
+                await add_balance(target, -amount, "admin_debit")
+                await update.message.reply_text(f"✅ تم خصم {amount} من المستخدم {target}.")
     elif action == "send_msg_to_user":
         target = context.user_data.get("admin_target")
         try:
             await context.bot.send_message(chat_id=target, text=text)
             await update.message.reply_text("✅ تم إرسال الرسالة.")
-        except Exception:
+        except TelegramError:
             await update.message.reply_text("خطأ عند إرسال الرسالة للمستخدم.")
     else:
         await update.message.reply_text("حالة غير معروفة.")
@@ -649,77 +3051,696 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     context.user_data.pop("admin_action", None)
     context.user_data.pop("admin_target", None)
     context.user_data.pop("admin_section", None)
+    context.user_data.pop("admin_product", None)
+
+# أمر عرض الطلبات للمستخدم
+# الوسائط: الحالة (اختيارية) ومؤشر الصفحة ("o", id) للأقدم أو ("n", id) للأحدث
+ORDER_STATUS_LABELS = {"all": "الكل", "pending": "قيد المراجعة", "accepted": "مقبولة", "rejected": "مرفوضة"}
 
-# ردود الازرار العامة
-async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@metrics.timed("bot_handler_seconds", "handler")
+async def my_orders_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, status=None, cursor=None):
     q = update.callback_query
-    if not q:
+    uid = q.from_user.id
+    if status not in ORDER_STATUS_LABELS:
+        status = "all"
+    before = after = None
+    if cursor:
+        direction, key = cursor
+        if direction == "n":
+            after = key
+        else:
+            before = key
+    rows, has_older, has_newer = await list_user_orders_page(
+        uid, None if status == "all" else status, before, after, ORDERS_PAGE_SIZE)
+    # الأرشيف يظهر كزر في آخر صفحة فقط: استعلام مفتاح أساسي واحد
+    archived = not has_older and await has_archived_orders(uid)
+    if not rows and not archived and status == "all" and before is None and after is None:
+        await q.edit_message_text("ليس لديك أي طلبات بعد.", reply_markup=main_menu_keyboard())
         return
-    data = q.data
-    # توجيه الأنواع المختلفة
-    if data == "show_balance":
-        await show_balance_cb(update, context)
-    elif data == "browse_sections":
-        await browse_sections_cb(update, context)
-    elif data.startswith("section:"):
-        await section_cb(update, context)
-    elif data.startswith("buy:"):
-        await buy_cb(update, context)
-    elif data.startswith("admin_") or data.startswith("admin"):
-        await admin_panel_cb(update, context)
-    elif data.startswith("admin_order_accept:"):
-        await admin_order_accept_cb(update, context)
-    elif data.startswith("admin_order_reject:"):
-        await admin_order_reject_cb(update, context)
-    else:
-        await q.answer("زر غير مفعل بعد.")
+    currency = settings.currency
+    text = f"🧾 طلباتك ({ORDER_STATUS_LABELS[status]}):\n"
+    if not rows:
+        text += "\nلا توجد طلبات بهذه الحالة.\n"
+    for oid, total, st, prod_name in rows:
+        text += f"\n#{oid} {prod_name or 'منتج محذوف'} — {total} {currency} — {st}\n"
+    kb = []
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("◀️ الأحدث", callback_data=cbdata("my_orders", status, ("n", rows[0][0]))))
+    if has_older:
+        nav.append(InlineKeyboardButton("الأقدم ▶️", callback_data=cbdata("my_orders", status, ("o", rows[-1][0]))))
+    if nav:
+        kb.append(nav)
+    if archived:
+        kb.append([InlineKeyboardButton("🗄 الطلبات المؤرشفة", callback_data=cbdata("my_orders_archive"))])
+    kb.append([InlineKeyboardButton(label, callback_data=cbdata("my_orders", key))
+               for key, label in ORDER_STATUS_LABELS.items() if key != status])
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("main_back"))])
+    await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
 
-# أمر عرض الطلبات للمستخدم
-async def my_orders_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# الطلبات المؤرشفة (الأقدم من ORDER_RETENTION_DAYS)، صفحات للأقدم فقط؛ before = id آخر طلب معروض
+@metrics.timed("bot_handler_seconds", "handler")
+async def my_orders_archive_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, before=None):
     q = update.callback_query
-    await q.answer()
-    uid = q.from_user.id
-    cur.execute("SELECT id, product_id, qty, total, status, created_at FROM orders WHERE user_id=? ORDER BY created_at DESC", (uid,))
-    rows = cur.fetchall()
+    rows, has_older = await list_archived_orders(q.from_user.id, before, ORDERS_PAGE_SIZE)
+    currency = settings.currency
+    text = "🗄 طلباتك المؤرشفة:\n"
     if not rows:
-        await q.edit_message_text("ليس لديك أي طلبات بعد.", reply_markup=main_menu_keyboard())
+        text += "\nلا توجد طلبات مؤرشفة.\n"
+    for oid, total, st, prod_name in rows:
+        text += f"\n#{oid} {prod_name or 'منتج محذوف'} — {total} {currency} — {st}\n"
+    kb = []
+    if has_older:
+        kb.append([InlineKeyboardButton("الأقدم ▶️", callback_data=cbdata("my_orders_archive", rows[-1][0]))])
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("my_orders"))])
+    await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+# البحث: /search نص أو "بحث نص"، والصفحات عبر زر search؛ النص المبحوث عنه في user_data
+def render_search_results(query, rows, page):
+    currency = settings.currency
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    text = f"🔍 نتائج البحث عن '{query}' — صفحة {page + 1}:\n"
+    if not rows:
+        text += "\nلا توجد نتائج."
+    kb = []
+    for pid, name, price, desc, _image_url in rows:
+        text += f"\n• {name} — {price} {currency}"
+        kb.append([InlineKeyboardButton(f"شراء {name}", callback_data=cbdata("buy", pid))])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=cbdata("search", page - 1)))
+    if has_more:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=cbdata("search", page + 1)))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data=cbdata("main_back"))])
+    return text, InlineKeyboardMarkup(kb)
+
+async def search_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    query = query.strip()
+    if not fts_query(query):
+        await update.message.reply_text("اكتب ما تبحث عنه، مثال: /search بطاقة")
+        return
+    context.user_data["search_query"] = query
+    rows = await search_products(query, SEARCH_PAGE_SIZE + 1)
+    text, markup = render_search_results(query, rows, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+@metrics.timed("bot_handler_seconds", "handler")
+async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await search_reply(update, context, " ".join(context.args or ()))
+
+@metrics.timed("bot_handler_seconds", "handler")
+async def search_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    q = update.callback_query
+    query = context.user_data.get("search_query")
+    if not query:
+        await q.edit_message_text("انتهى هذا البحث، ابحث من جديد بـ /search", reply_markup=main_menu_keyboard())
         return
-    text = "🧾 طلباتك:\n"
-    for r in rows:
-        oid, pid, qty, total, status, created_at = r
-        cur.execute("SELECT name FROM products WHERE id=?", (pid,))
-        prod = cur.fetchone()
-        prod_name = prod[0] if prod else "منتج محذوف"
-        text += f"\n#{oid} {prod_name} — {total} {load_setting('currency')} — {status}\n"
-    await q.edit_message_text(text, reply_markup=main_menu_keyboard())
+    page = max(page or 0, 0)
+    rows = await search_products(query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    text, markup = render_search_results(query, rows, page)
+    await q.edit_message_text(text, reply_markup=markup)
+
+# البحث المضمّن (@bot نص) — يتطلب تفعيل inline mode من BotFather
+def inline_buy_keyboard(pid, price, currency, nonce=0):
+    # nonce يتغير بعد كل شراء ناجح من البطاقة (رقم الطلب)، فيختلف مفتاح الشراء المقصود التالي
+    return InlineKeyboardMarkup([[InlineKeyboardButton(f"شراء — {price} {currency}", callback_data=cbdata("buy", pid, nonce))]])
+
+@metrics.timed("bot_handler_seconds", "handler")
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    try:
+        offset = max(int(iq.offset or 0), 0)
+    except ValueError:
+        offset = 0
+    rows = await search_products(iq.query, INLINE_PAGE_SIZE + 1, offset)
+    has_more = len(rows) > INLINE_PAGE_SIZE
+    currency = settings.currency
+    results = []
+    for pid, name, price, desc, image_url in rows[:INLINE_PAGE_SIZE]:
+        results.append(InlineQueryResultArticle(
+            id=str(pid),
+            title=name,
+            description=f"{price} {currency}" + (f" — {desc[:80]}" if desc else ""),
+            input_message_content=InputTextMessageContent(f"🛍️ {name}\n{price} {currency}" + (f"\n{desc}" if desc else "")),
+            reply_markup=inline_buy_keyboard(pid, price, currency),
+            thumbnail_url=image_url or None,
+        ))
+    await iq.answer(results, cache_time=INLINE_CACHE_SECONDS,
+                    next_offset=str(offset + INLINE_PAGE_SIZE) if has_more else "")
 
 # رسالة نصية عامة للمستخدمين (غير الأدمن) — ردود سريعة
+@metrics.timed("bot_handler_seconds", "handler")
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
-    if is_banned(uid):
-        await update.message.reply_text("حسابك محظور.")
-        return
     txt = update.message.text or ""
     # بعض الأوامر النصية السهلة
     if txt.strip() == "/balance" or txt.strip().lower() == "رصيدي":
-        bal = get_balance(uid)
-        await update.message.reply_text(f"💰 رصيدك: {bal} {load_setting('currency')}")
+        bal = await get_balance(uid)
+        await update.message.reply_text(f"💰 رصيدك: {bal} {settings.currency}")
+        return
+    if txt.strip().startswith("بحث"):
+        await search_reply(update, context, txt.strip()[len("بحث"):])
         return
     # رد افتراضي
     await update.message.reply_text("استخدم الأزرار أو /start لتصفح المتجر.", reply_markup=main_menu_keyboard())
 
+# أزرار الرسائل المضمّنة (بطاقات البحث المضمّن): لا تعدّل الرسالة المشتركة بمحتوى شخصي
+INLINE_ROUTES = {"buy"}
+
+# جدول الأزرار: الاسم (= بادئة الصيغة القديمة)، الرمز المختصر، الـ handler، أنواع الوسائط، للأدمن فقط
+CALLBACK_ROUTES = [
+    ("show_balance", "sb", show_balance_cb, (), False),
+    ("browse_sections", "bs", browse_sections_cb, (), False),
+    ("section", "s", section_cb, (CB_INT,), False),
+    ("product", "p", product_cb, (CB_INT,), False),
+    ("buy", "b", buy_cb, (CB_INT, CB_INT), False),
+    ("my_orders", "mo", my_orders_cb, (CB_STR, CB_CURSOR), False),
+    ("my_orders_archive", "ma", my_orders_archive_cb, (CB_INT,), False),
+    ("main_back", "mb", main_back_cb, (), False),
+    ("search", "q", search_page_cb, (CB_INT,), False),
+    ("subscriptions", "sub", None, (), False),
+    # الطلبات
+    ("admin_order_accept", "oa", admin_order_accept_cb, (CB_INT,), True),
+    ("admin_order_reject", "or", admin_order_reject_cb, (CB_INT,), True),
+    ("admin_orders_pending", "dp", functools.partial(admin_orders_cb, action="pending"), (), True),
+    ("admin_orders_toggle", "dt", functools.partial(admin_orders_cb, action="toggle"), (CB_INT,), True),
+    ("admin_orders_accept", "da", functools.partial(admin_orders_cb, action="accept"), (), True),
+    ("admin_orders_reject", "dr", functools.partial(admin_orders_cb, action="reject"), (), True),
+    ("admin_stats", "sx", admin_stats_cb, (CB_INT,), True),
+    # لوحة الأدمن
+    ("admin_back", "a", admin_back_cb, (), True),
+    ("admin_store", "st", admin_store_cb, (), True),
+    ("admin_messages", "ms", admin_messages_cb, (), True),
+    ("admin_settings", "se", admin_settings_cb, (), True),
+    ("admin_edit_welcome", "ew", admin_prompt("edit_welcome", "أرسل النص الجديد لرسالة الترحيب الآن."), (), True),
+    ("admin_broadcast", "bc", admin_prompt("broadcast", "أرسل رسالة البث الآن. (سيتم إرسالها لكل المستخدمين المسجلين)"), (), True),
+    ("admin_currency", "cu", admin_prompt("set_currency", "أرسل رمز العملة الجديد (مثال SYP)."), (), True),
+    # المتجر
+    ("admin_list_sections", "ls", admin_list_sections_cb, (), True),
+    ("admin_add_section", "as", admin_prompt("add_section", "أرسل اسم القسم الجديد الآن (أو ألغِ)."), (), True),
+    ("admin_section_manage", "sm", admin_section_manage_cb, (CB_INT,), True),
+    ("admin_delete_section", "xs", admin_delete_section_cb, (CB_INT,), True),
+    ("admin_list_products", "lp", admin_list_products_cb, (CB_INT,), True),
+    ("admin_add_product", "ap", admin_prompt("add_product", "أرسل تفاصيل المنتج بصيغة:\nالاسم | السعر | الوصف (الصور والازرار لاحقاً).",
+                                             "admin_section"), (CB_INT,), True),
+    ("admin_product_manage", "pm", admin_product_manage_cb, (CB_INT,), True),
+    ("admin_edit_product_name", "pn", admin_prompt("edit_product_name", "أرسل الاسم الجديد للمنتج {target}.", "admin_product"), (CB_INT,), True),
+    ("admin_edit_product_price", "pp", admin_prompt("edit_product_price", "أرسل السعر الجديد للمنتج {target} (رقم).", "admin_product"), (CB_INT,), True),
+    ("admin_edit_product_stock", "pk", admin_prompt("set_product_stock", "أرسل الكمية المتوفرة (رقم)، أو - لمخزون غير محدود.", "admin_product"), (CB_INT,), True),
+    ("admin_edit_product_image", "pi", admin_prompt("set_product_image", "أرسل رابط الصورة (http/https)، أو - لإزالة الصورة.", "admin_product"), (CB_INT,), True),
+    ("admin_delete_product", "xp", admin_delete_product_cb, (CB_INT,), True),
+    # المستخدمون
+    ("admin_users", "us", admin_users_cb, (), True),
+    ("admin_users_page", "pg", admin_users_page_cb, (CB_INT,), True),
+    ("admin_users_filter", "uf", admin_users_filter_cb, (CB_STR,), True),
+    ("admin_users_search", "uq", admin_prompt("search_users", "أرسل ID المستخدم أو بداية اسم المستخدم للبحث."), (), True),
+    ("admin_user", "u", admin_user_cb, (CB_INT,), True),
+    ("admin_user_add", "u+", admin_prompt("user_add_balance", "أدخل المبلغ الذي تريد إضافته للمستخدم {target}:", "admin_target"), (CB_INT,), True),
+    ("admin_user_sub", "u-", admin_prompt("user_sub_balance", "أدخل المبلغ الذي تريد خصمه من المستخدم {target}:", "admin_target"), (CB_INT,), True),
+    ("admin_user_reset", "u0", admin_user_reset_cb, (CB_INT,), True),
+    ("admin_user_ledger", "ul", admin_user_ledger_cb, (CB_INT,), True),
+    ("admin_user_ban", "ub", admin_user_ban_cb, (CB_INT,), True),
+    ("admin_user_unban", "uu", admin_user_unban_cb, (CB_INT,), True),
+    ("admin_user_msg", "um", admin_prompt("send_msg_to_user", "اكتب الرسالة التي تريد إرسالها للمستخدم {target}:", "admin_target"), (CB_INT,), True),
+]
+
+for _route in CALLBACK_ROUTES:
+    callbacks.add(*_route)
+
 # === تهيئة التطبيق وإضافة الhandlers ===
 
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+# === معالجة متوازية مع الحفاظ على ترتيب كل مستخدم ===
+
+class KeyedLocks:
+    # قفل asyncio لكل مفتاح، يُحذف عند انتهاء آخر مستخدم له (ذاكرة بحجم المستخدمين النشطين فقط)
+
+    def __init__(self):
+        self._locks = {}  # key -> [lock, users]
+
+    async def _acquire(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._release_ref(key, entry)
+            raise
+        return entry
+
+    def _release_ref(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    async def run(self, key, coro_fn):
+        entry = await self._acquire(key)
+        try:
+            return await coro_fn()
+        finally:
+            entry[0].release()
+            self._release_ref(key, entry)
+
+    def __len__(self):
+        return len(self._locks)
+
+class OrderedApplication(Application):
+    # مع concurrent_updates يعالج PTB التحديثات بالتوازي؛ هنا نضمن أن تحديثات نفس
+    # المستخدم تُعالج واحداً تلو الآخر، فلا تتداخل حالة admin_action في user_data.
+    # PTB 20.3 يأخذ مقعداً من _concurrent_updates_sem قبل process_update، فتحديثات
+    # مستخدم واحد المنتظِرة لقفله كانت تحجز المقاعد عن الجميع. لذلك نتجاوز ذلك الغلاف
+    # ونأخذ مقعداً من _slots (بنفس الحد) داخل قفل المستخدم: المنتظر لا يحجز شيئاً.
+    # الغلاف خاص بـ PTB، لذا الإصدار مثبّت في requirements.txt ونتحقق عند الإقلاع أن
+    # _update_fetcher ما زال يستدعيه، وإلا لتخطّت التحديثات admit وأقفال المستخدمين بصمت.
+
+    def __init__(self, **kwargs):
+        if "_Application__process_update_wrapper" not in Application._update_fetcher.__code__.co_names:
+            raise Exception("إصدار python-telegram-bot غير مدعوم: OrderedApplication تحتاج 20.3 "
+                            "(Application.__process_update_wrapper). ثبّت ما في requirements.txt.")
+        super().__init__(**kwargs)
+        self._user_locks = KeyedLocks()
+        self._slots = asyncio.BoundedSemaphore(max(1, self.concurrent_updates))
+
+    async def _Application__process_update_wrapper(self, update):
+        await self.process_update(update)
+        self.update_queue.task_done()
+
+    async def _process(self, update):
+        async with self._slots:
+            return await super().process_update(update)
+
+    async def process_update(self, update):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            return await self._process(update)
+        if not await admit(update):
+            return None
+        return await self._user_locks.run(user.id, lambda: self._process(update))
+
+# === حفظ حالة PTB في DB ===
+# حالة الأدمن متعددة الخطوات (admin_action وهدفها) تبقى بعد إعادة التشغيل. لا يُقرأ شيء عند
+# الإقلاع: صف المستخدم/المحادثة يُقرأ بالمفتاح الأساسي عند أول تحديث له في هذه العملية
+# (refresh_*). حالة الواجهة المؤقتة (EPHEMERAL_KEYS) لا تُحفظ، فلا يصير لكل من بحث صف.
+# PTB يمرر كل update_interval المستخدمين الذين تعاملوا مع البوت فقط، ونكتب منهم من تغيّر
+# JSON بياناته عن آخر نسخة محفوظة، كلهم في معاملة واحدة.
+
+# تبقى في user_data بالذاكرة فقط (نص البحث ومؤشرات صفحات المستخدمين للأدمن)
+EPHEMERAL_KEYS = frozenset({"search_query", "admin_users_view"})
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        # مع عدة عمليات: user_data/chat_data لكل مستخدم في عاملٍ واحد، وbot_data للعامل القائد فقط
+        super().__init__(store_data=PersistenceInput(callback_data=False, bot_data=cluster.leader),
+                         update_interval=update_interval)
+        self._stored = {}    # (kind, id) -> آخر JSON مكتوب
+        self._seen = {"user": set(), "chat": set()}  # مفاتيح قُرئ صفها في هذه العملية
+        self._pending = {}   # (kind, id) -> JSON أو None للحذف
+
+    @staticmethod
+    def _dumps(data):
+        data = {k: v for k, v in data.items() if k not in EPHEMERAL_KEYS}
+        if not data:
+            return None
+        try:
+            return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        except (TypeError, ValueError) as e:
+            logger.warning("Persistence: data is not JSON serializable: %s", e)
+            return None
+
+    async def _refresh(self, kind, key, data):
+        # أول تحديث لهذا المفتاح في العملية: دمج المحفوظ (إن وُجد) في الـ dict الذي أنشأه PTB
+        if key in self._seen[kind]:
+            return
+        self._seen[kind].add(key)
+        row = await db.fetchone("SELECT data FROM persistence WHERE kind=? AND id=?", (kind, key))
+        if row:
+            self._stored[(kind, key)] = row[0]
+            for k, v in json.loads(row[0]).items():
+                data.setdefault(k, v)
+
+    async def _stage(self, kind, key, data):
+        blob = self._dumps(data)
+        if blob == self._stored.get((kind, key)):
+            return
+        self._pending[(kind, key)] = blob
+        # PTB يستدعي update_* لكل المفاتيح معاً (gather): ننتظر دورة واحدة ليُجمع الكل ثم نكتب مرة واحدة
+        await asyncio.sleep(0)
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            await db.write(self._write_batch, batch)
+            self._stored.update(batch)
+            metrics.inc("bot_persistence_writes_total", len(batch))
+
+    @staticmethod
+    def _write_batch(c, batch):
+        ts = now_ts()
+        for (kind, key), blob in batch.items():
+            if blob is None:
+                c.execute("DELETE FROM persistence WHERE kind=? AND id=?", (kind, key))
+            else:
+                c.execute("INSERT OR REPLACE INTO persistence (kind, id, data, updated_at) VALUES (?, ?, ?, ?)",
+                          (kind, key, blob, ts))
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        row = await db.fetchone("SELECT data FROM persistence WHERE kind='bot' AND id=0")
+        if not row:
+            return {}
+        self._stored[("bot", 0)] = row[0]
+        return json.loads(row[0])
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        await self._stage("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._stage("chat", chat_id, data)
+
+    async def update_bot_data(self, data):
+        await self._stage("bot", 0, data)
+
+    async def drop_user_data(self, user_id):
+        await self._stage("user", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        await self._stage("chat", chat_id, None)
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def flush(self):
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            await db.write(self._write_batch, batch)
+            self._stored.update(batch)
+
+# === وضع متعدد العمليات (BOT_WORKERS) ===
+# عملية استقبال واحدة (polling أو webhook) تمرر كل تحديث كما هو إلى عامل واحد من N حسب
+# المستخدم (user_id % N)، فتبقى تحديثات المستخدم الواحد وuser_data الخاص به في عملية واحدة
+# وبترتيب وصولها. الاتصال TCP محلي بأسطر JSON، بدون أي وسيط خارجي. كل عامل يفتح data.db
+# بكاتبه الخاص (WAL وBEGIN IMMEDIATE مع busy timeout تكفي لعدة عمليات)، وكل إلغاء لكاش
+# في الذاكرة (settings، الكتالوج، الحظر) يُرسل إلى الاستقبال الذي يعيد بثه لباقي العمال.
+# المهام المفردة (استئناف البث وفحص الدفتر) تعمل في العامل "القائد" المسؤول عن الأدمن.
+# الإرسال لمحادثة من غير عاملها (إشعارات الطلبات للأدمن، إبلاغ أصحاب الطلبات) يُوجَّه عبر
+# الاستقبال إلى ذلك العامل، فيبقى digest الأدمن وحد كل محادثة واحداً مهما كان عدد العمال.
+# الاستثناء البث (bulk، رسالة واحدة لكل محادثة) الذي يرسله القائد مباشرة.
+
+SHARD_LINE_LIMIT = 16 * 1024 * 1024
+
+def _frame(message):
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+class Cluster:
+    # دور هذه العملية: BOT_SHARD="<index>/<count>" يضبطه الاستقبال للعمال؛ بدونه عملية واحدة
+
+    def __init__(self, shard=None):
+        if shard:
+            index, count = shard.split("/")
+            self.index, self.count = int(index), int(count)
+        else:
+            self.index, self.count = None, 1
+        self._writer = None
+        self._bot = None
+
+    @property
+    def leader(self):
+        return self.index is None or self.index == self.shard_of(ADMIN_ID)
+
+    def shard_of(self, key):
+        # نفس توزيع Ingress.forward
+        return key % self.count
+
+    def owns(self, chat_id):
+        # كل محادثة لها عامل مالك واحد (عامل مستخدمها): وحده يرسل إليها، فيبقى حد المحادثة
+        # في ApiScheduler وتجميع إشعارات الأدمن في OrderNotifier حداً واحداً لا N
+        return self.index is None or self.shard_of(chat_id) == self.index
+
+    def attach(self, writer, bot=None):
+        self._writer = writer
+        self._bot = bot
+
+    def publish(self, kind, *args):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_frame({"i": [kind, *args]}))
+
+    def send(self, chat_id, kind, *args):
+        # رسالة لعامل المحادثة المالك وحده عبر الاستقبال؛ False = لا رابط (يُنفذ محلياً)
+        if self._writer is None or self._writer.is_closing():
+            return False
+        self._writer.write(_frame({"t": self.shard_of(chat_id), "i": [kind, *args]}))
+        return True
+
+    def apply(self, message):
+        # إلغاء قادم من عامل آخر: يُطبق محلياً فقط (بدون إعادة نشر). order/tell: إرسال موجّه
+        # لهذا العامل لأنه مالك المحادثة
+        kind, *args = message
+        if kind == "order":
+            order_notifier.notify(self._bot, tuple(args[0]))
+        elif kind == "tell":
+            order_notifier.tell_users(self._bot, [tuple(m) for m in args[0]])
+        elif kind == "setting":
+            settings.set(*args)
+        elif kind == "catalog":
+            catalog.drop(*args)
+        elif kind == "ban":
+            user_id, banned = args
+            if banned:
+                banned_ids.add(user_id)
+            else:
+                banned_ids.discard(user_id)
+        metrics.inc("bot_cluster_invalidations_total", kind=kind)
+
+
+cluster = Cluster(os.getenv("BOT_SHARD"))
+
+def update_shard_key(update):
+    user = update.effective_user
+    if user is not None:
+        return user.id
+    chat = update.effective_chat
+    return chat.id if chat is not None else 0
+
+class Ingress:
+    # عملية الاستقبال: لا handlers ولا DB، فقط توجيه التحديثات وإعادة بث الإلغاءات.
+    # سقوط أي عامل يوقف الاستقبال كله ليعيد مدير الخدمة تشغيله (لا نعيد توجيه مستخدميه لعامل آخر).
+
+    def __init__(self, count, sock):
+        self.count = count
+        self.sock = sock
+        self._links = [None] * count
+        self._connected = asyncio.Event()
+        self._server = None
+        self._metrics_server = None
+        self._stopping = False
+        self._app = None
+        self._handlers = set()
+
+    async def start(self, app):
+        self._app = app
+        if metrics.enabled:
+            self._metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+        self._server = await asyncio.start_server(self._accept, sock=self.sock, limit=SHARD_LINE_LIMIT)
+        await asyncio.wait_for(self._connected.wait(), timeout=120)
+        print(f"Ingress: {self.count} workers connected")
+
+    async def _accept(self, reader, writer):
+        try:
+            index = json.loads(await reader.readline())["w"]
+        except (ValueError, KeyError, TypeError):
+            writer.close()
+            return
+        self._links[index] = writer
+        self._handlers.add(asyncio.current_task())
+        if all(self._links):
+            self._connected.set()
+        try:
+            while line := await reader.readline():
+                if line.startswith(b'{"t":'):
+                    # موجّهة لعامل واحد (Cluster.send)
+                    link = self._links[json.loads(line)["t"]]
+                    if link is not None:
+                        link.write(line)
+                    continue
+                for i, link in enumerate(self._links):
+                    if i != index and link is not None:
+                        link.write(line)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._links[index] = None
+            writer.close()
+            if not self._stopping:
+                logger.error("Worker %d disconnected; stopping ingress", index)
+                self._app.stop_running()
+
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # التطبيق يعالج التحديثات واحداً تلو الآخر، فيصل كل عامل تحديثاته بنفس ترتيب Telegram
+        link = self._links[update_shard_key(update) % self.count]
+        if link is None:
+            return  # العامل سقط والاستقبال في طريقه للتوقف
+        link.write(_frame({"u": update.to_dict()}))
+        await link.drain()
+        metrics.inc("bot_ingress_updates_total")
+
+    async def stop(self, app):
+        # إغلاق الروابط = إشارة الإيقاف للعمال: ينهون ما وصلهم ثم يغلقون روابطهم ويخرجون
+        self._stopping = True
+        for link in self._links:
+            if link is not None:
+                link.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers, timeout=60)
+        for server in (self._server, self._metrics_server):
+            if server is not None:
+                server.close()
+
+def run_ingress(count):
+    sock = socket.create_server((SHARD_HOST, SHARD_PORT))
+    host, port = sock.getsockname()[:2]
+    ctx = multiprocessing.get_context("spawn")
+    workers = []
+    # كل عامل يرث البيئة عند start: دوره، حصته من الحد العام لطلبات Bot API، ومنفذ قياساته
+    base_env = dict(os.environ)
+    for i in range(count):
+        os.environ["BOT_SHARD"] = f"{i}/{count}"
+        os.environ["API_GLOBAL_RATE"] = str(API_GLOBAL_RATE / count)
+        os.environ["API_BULK_RATE"] = str(API_BULK_RATE / count)
+        if METRICS_PORT:
+            os.environ["METRICS_PORT"] = str(METRICS_PORT + 1 + i)
+        p = ctx.Process(target=run_worker, args=(host, port), name=f"bot-worker-{i}")
+        p.start()
+        workers.append(p)
+    os.environ.clear()
+    os.environ.update(base_env)
+
+    ingress = Ingress(count, sock)
+    app = (ApplicationBuilder().token(BOT_TOKEN)
+           .request(ScheduledRequest(api_scheduler, API_POOL_SIZE, API_KEEPALIVE, API_POOL_TIMEOUT))
+           .post_init(ingress.start).post_shutdown(ingress.stop)
+           .build())
+    app.add_handler(TypeHandler(Update, ingress.forward))
+    try:
+        run_application(app)
+    finally:
+        for p in workers:
+            p.join(timeout=60)
+            if p.is_alive():
+                p.terminate()
+
+def run_worker(host, port):
+    # الإيقاف يأتي من الاستقبال (إغلاق الرابط) لا من الإشارات، فتُكمل التحديثات الجارية دائماً
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_loop(host, port))
+
+async def _worker_loop(host, port):
+    app = build_application(updater=False)
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    reader, writer = await asyncio.open_connection(host, port, limit=SHARD_LINE_LIMIT)
+    writer.write(_frame({"w": cluster.index}))
+    cluster.attach(writer, app.bot)
+    try:
+        while line := await reader.readline():
+            message = json.loads(line)
+            if "u" in message:
+                await app.update_queue.put(Update.de_json(message["u"], app.bot))
+            else:
+                cluster.apply(message["i"])
+    finally:
+        cluster.attach(None)
+        await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+        writer.close()
+
+metrics_server = None
+background_tasks = []
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc("bot_handler_errors_total", error=type(context.error).__name__)
+    logger.error("Unhandled error while processing update", exc_info=context.error)
+
+async def on_startup(app):
+    global metrics_server
+    if metrics.enabled:
+        metrics.gauge("bot_update_queue_depth", app.update_queue.qsize)
+        metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+        print(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    await catalog.warm()
+    if not cluster.leader:
+        return
+    # استئناف أي بث قُطع بإعادة التشغيل
+    for bid in await list_running_broadcasts():
+        broadcaster.start(app.bot, bid)
+    background_tasks.append(asyncio.get_running_loop().create_task(
+        ledger_reconcile_loop(LEDGER_RECONCILE_INTERVAL, LEDGER_RECONCILE_CHUNK)))
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL, first=60, name="order_retention")
+    else:
+        logger.warning("JobQueue unavailable (install python-telegram-bot[job-queue]); "
+                       "running order retention as a background task")
+        background_tasks.append(asyncio.get_running_loop().create_task(
+            retention_loop(app.bot, RETENTION_INTERVAL)))
+
+async def on_shutdown(app):
+    await broadcaster.stop()
+    await order_notifier.stop()
+    await media_cache.stop()
+    await api_scheduler.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    # تفريغ طابور الكتابة وإغلاق اتصالات DB قبل الخروج
+    db.close()
+
+def register_handlers(app):
+    # مشتركة بين main() وbench.py حتى يقيس الـ benchmark نفس مسار التوجيه الحقيقي
+    app.add_error_handler(on_error)
 
     # Commands
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("admin", cmd_admin))
+    app.add_handler(CommandHandler("search", cmd_search))
+
+    # البحث المضمّن
+    app.add_handler(InlineQueryHandler(inline_search))
 
-    # Callbacks
-    app.add_handler(CallbackQueryHandler(callback_router))
+    # Callbacks: كل الأزرار عبر جدول CALLBACK_ROUTES (فحص الطول والتصادم عند الإقلاع)
+    callbacks.check()
+    app.add_handler(CallbackQueryHandler(callbacks.dispatch))
 
     # Admin text-entry handler (only when admin is typing inputs)
     app.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_ID), admin_message_handler))
@@ -727,8 +3748,74 @@ def main():
     # General text messages
     app.add_handler(MessageHandler(filters.TEXT & (~filters.User(ADMIN_ID)), text_handler))
 
-    print("Bot starting...")
-    app.run_polling(stop_signals=None)
+def main():
+    if "--check-plans" in sys.argv[1:]:
+        c = db.connect()
+        problems = check_query_plans(c)
+        c.close()
+        for sql, detail in problems:
+            print(f"FULL SCAN: {detail}\n  {sql}")
+        print("OK" if not problems else f"{len(problems)} full scan(s)")
+        sys.exit(1 if problems else 0)
+    if "--rebuild-stats" in sys.argv[1:]:
+        # إعادة بناء جداول المبيعات من orders (آمن أثناء عمل البوت: معاملة كتابة واحدة)
+        c = db.connect()
+        c.isolation_level = None
+        c.execute("BEGIN IMMEDIATE")
+        days = _rebuild_sales_rollups(c)
+        c.execute("COMMIT")
+        c.close()
+        print(f"Sales rollups rebuilt: {days} day(s)")
+        sys.exit(0)
+    if "--enable-incremental-vacuum" in sys.argv[1:]:
+        # مرة واحدة والبوت متوقف: VACUUM يعيد كتابة الملف كله ويحتاج مساحة بقدره
+        c = db.connect()
+        c.isolation_level = None
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        print("DB: running VACUUM...")
+        c.execute("VACUUM")
+        mode = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+        c.close()
+        print("Incremental vacuum enabled" if mode == 2 else "Could not enable incremental vacuum")
+        sys.exit(0 if mode == 2 else 1)
+
+    if BOT_WORKERS > 0:
+        print(f"Bot starting ({BOT_WORKERS} workers)...")
+        run_ingress(BOT_WORKERS)
+    else:
+        run_application(build_application())
+
+def build_application(updater=True):
+    # العامل في وضع BOT_WORKERS بلا updater: تحديثاته تصله من الاستقبال
+    builder = (ApplicationBuilder().token(BOT_TOKEN)
+               .application_class(OrderedApplication)
+               .concurrent_updates(CONCURRENT_UPDATES)
+               .persistence(SQLitePersistence())
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    builder = builder.request(ScheduledRequest(api_scheduler, API_POOL_SIZE, API_KEEPALIVE, API_POOL_TIMEOUT))
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    register_handlers(app)
+    return app
+
+def run_application(app):
+    if BOT_MODE == "webhook":
+        # خادم HTTP محلي؛ PTB يرفض أي طلب لا يحمل X-Telegram-Bot-Api-Secret-Token الصحيح.
+        # SIGINT/SIGTERM يوقفان الاستقبال ثم تُنهى التحديثات الجارية وon_shutdown قبل الخروج.
+        secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        print(f"Bot starting (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        print("Bot starting...")
+        app.run_polling(stop_signals=None)
 
 
 if __name__ == "__main__":